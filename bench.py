@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import json
+import random
+import socket
+import shutil
+import resource
+import tempfile
+import subprocess
+import urllib.parse
+import http.server
+from datetime import datetime, timezone
+import argparse
+import psycopg2
+import crawl
+
+
+def load_corpus(corpus_dir):
+    pages = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if not file_name.endswith(".html"):
+            continue
+        with open(os.path.join(corpus_dir, file_name), "r", encoding="utf-8", errors="replace") as file:
+            pages.append((file_name, file.read()))
+    return pages
+
+
+def time_parser(parse, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, page in pages:
+            parse(page)
+    return time.perf_counter() - start
+
+
+# compare the single pass item page parser with the old extractor, on a directory of saved item pages
+def bench_parse(args):
+    pages = load_corpus(args.dir)
+    if not pages:
+        print("Error: no .html files in", args.dir)
+        sys.exit(1)
+
+    crawl_util = crawl.CrawlerUtil(False, { 'backend': 'curl' })
+    hncrawl = crawl.HNCrawlerUtil(False, crawl_util)
+
+    def parse_legacy(page):
+        crawl_util.set_page(page)
+        return hncrawl.parse_item_page_legacy()
+
+    mismatch = 0
+    for file_name, page in pages:
+        old_fields = parse_legacy(page)
+        new_fields = crawl.HNCrawlerUtil.parse_item_page(page)
+        if old_fields != new_fields:
+            mismatch += 1
+            print("mismatch:", file_name, "old:", old_fields, "new:", new_fields)
+
+    total_bytes = sum(len(page) for _, page in pages) * args.repeat
+    time_old = time_parser(parse_legacy, pages, args.repeat)
+    time_new = time_parser(crawl.HNCrawlerUtil.parse_item_page, pages, args.repeat)
+
+    num_pages = len(pages) * args.repeat
+    for name, seconds in (("old extractor", time_old), ("single pass", time_new)):
+        print(f"{name:14}: {seconds:.3f} sec {num_pages / seconds:.0f} pages/sec {total_bytes / seconds / 1e6:.1f} MB/sec")
+    print(f"speedup: {time_old / time_new:.1f}x pages: {len(pages)} mismatches: {mismatch}")
+
+    if mismatch != 0:
+        sys.exit(1)
+
+
+# stand-in for hn: serves item pages, listing pages and the json api for the entry ids max_id - items < id <= max_id.
+# The pages are made up (the same for each entry id on each run), or read from the corpus directory
+# (<id>.html for item pages, <id>.json for api items), if they are there.
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are two writes on a keep-alive connection: without TCP_NODELAY the body waits for
+    # the delayed ack of the client (~40ms a request)
+    disable_nagle_algorithm = True
+
+    # set by serve
+    config = None
+
+    ITEMS_PER_LISTING = 30
+    BASE_TIME = 1700000000
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        config = StubHandler.config
+        rand = random.Random()
+        if config.latency > 0:
+            time.sleep(rand.uniform(0.5, 1.5) * config.latency / 1000.0)
+        if rand.random() < config.error_rate:
+            # half of the errors look like the hn throttle page
+            if rand.random() < 0.5:
+                self.reply(503, "text/plain", "Service Unavailable")
+            else:
+                self.reply(200, "text/html", "<html><body>Sorry, we're not able to serve your requests this quickly.</body></html>")
+            return
+
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        path = parts.path
+
+        if path == "/item" and "id" in query:
+            self.reply_item(int(query["id"][0]), ".html")
+        elif path.startswith("/v0/item/") and path.endswith(".json"):
+            self.reply_item(int(path[len("/v0/item/"):-len(".json")]), ".json")
+        elif path == "/v0/maxitem.json":
+            self.reply(200, "application/json", str(config.max_id))
+        elif path == "/newcomments":
+            self.reply(200, "text/html", StubHandler.listing_page([config.max_id], ""))
+        elif path == "/newest":
+            next_id = int(query.get("next", [config.max_id])[0])
+            num = int(query.get("n", [1])[0])
+            ids = StubHandler.listing_ids(next_id)
+            more = f'<a href="newest?next={ids[-1] - 1}&amp;n={num + len(ids)}" class="morelink" rel="next">More</a>' if ids else ""
+            self.reply(200, "text/html", StubHandler.listing_page(ids, more))
+        elif path in ("/news", "/ask", "/show"):
+            page = int(query.get("p", [1])[0])
+            ids = StubHandler.listing_ids(config.max_id - (page - 1) * StubHandler.ITEMS_PER_LISTING * 5)
+            self.reply(200, "text/html", StubHandler.listing_page(ids, ""))
+        else:
+            self.reply(404, "text/plain", "Unknown.")
+
+    def reply(self, status, content_type, text):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_item(self, entry_id, suffix):
+        config = StubHandler.config
+        if config.corpus:
+            file_name = os.path.join(config.corpus, f"{entry_id}{suffix}")
+            if os.path.exists(file_name):
+                with open(file_name, "r", encoding="utf-8", errors="replace") as file:
+                    self.reply(200, "application/json" if suffix == ".json" else "text/html", file.read())
+                return
+
+        if not config.min_id < entry_id <= config.max_id:
+            if suffix == ".json":
+                self.reply(200, "application/json", "null")
+            else:
+                self.reply(200, "text/html", "No such item.")
+        elif suffix == ".json":
+            self.reply(200, "application/json", json.dumps(StubHandler.api_item(entry_id)))
+        else:
+            self.reply(200, "text/html", StubHandler.item_page(entry_id))
+
+    # fields of a made up item: every fifth entry is a post, some are flagged or deleted
+    @staticmethod
+    def item_fields(entry_id):
+        rand = random.Random(entry_id)
+        return {
+            "is_post": entry_id % 5 == 0,
+            "flagged": entry_id % 13 == 0,
+            "deleted": entry_id % 31 == 0,
+            "author": f"user{rand.randrange(10000)}",
+            "time": StubHandler.BASE_TIME + entry_id % 10000000,
+            "score": rand.randrange(1, 500),
+            "comments": rand.randrange(0, 300),
+            "parent": entry_id - rand.randrange(1, 1000),
+            "text": " ".join(f"word{rand.randrange(1000)}" for _ in range(rand.randrange(20, 200))),
+        }
+
+    @staticmethod
+    def item_page(entry_id):
+        fields = StubHandler.item_fields(entry_id)
+        post_time = datetime.fromtimestamp(fields["time"], timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        age = f'<span class="age" title="{post_time}"><a href="item?id={entry_id}">1 hour ago</a></span>'
+        user = f'<a href="user?id={fields["author"]}" class="hnuser">{fields["author"]}</a>'
+        if fields["is_post"]:
+            title = f'<span class="titleline"><a href="https://example.com/{entry_id}">Story number {entry_id}</a></span>'
+            if fields["deleted"]:
+                title = "[deleted]"
+            elif fields["flagged"]:
+                title += " [flagged]"
+            item = (
+                f'<tr class="athing" id="{entry_id}"><td class="title">{title}</td></tr>'
+                f'<tr><td class="subtext"><span class="score" id="score_{entry_id}">{fields["score"]} points</span> by {user} {age}'
+                f' | <a href="item?id={entry_id}">{fields["comments"]}&nbsp;comments</a></td></tr>'
+            )
+        else:
+            status = " [flagged]" if fields["flagged"] else ""
+            if fields["deleted"]:
+                status = " [deleted]"
+            item = (
+                f'<tr class="athing" id="{entry_id}"><td class="default"><div><span class="comhead">{user} {age}{status}'
+                f' <span class="onstory"> | on: <a href="item?id={fields["parent"]}">Story number {fields["parent"]}</a></span>'
+                f'</span></div><br><div class="comment">{fields["text"]}</div></td></tr>'
+            )
+        return (
+            f'<html><head><title>Hacker News</title></head><body><center><table id="hnmain">'
+            f'<tr><td><table class="fatitem" border="0">{item}</table></td></tr>'
+            f'<tr><td><table class="comment-tree">{fields["text"] * 4}</table></td></tr>'
+            f'</table></center></body></html>'
+        )
+
+    @staticmethod
+    def api_item(entry_id):
+        fields = StubHandler.item_fields(entry_id)
+        item = { "id": entry_id, "by": fields["author"], "time": fields["time"] }
+        if fields["is_post"]:
+            item.update({ "type": "story", "title": f"Story number {entry_id}", "url": f"https://example.com/{entry_id}",
+                          "score": fields["score"], "descendants": fields["comments"] })
+        else:
+            item.update({ "type": "comment", "parent": fields["parent"], "text": fields["text"] })
+        if fields["flagged"]:
+            item["dead"] = True
+        if fields["deleted"]:
+            item["deleted"] = True
+        return item
+
+    # the posts (not the comments) from first_id down, for one listing page
+    @staticmethod
+    def listing_ids(first_id):
+        ids = []
+        entry_id = first_id
+        while len(ids) < StubHandler.ITEMS_PER_LISTING and entry_id > StubHandler.config.min_id:
+            if StubHandler.item_fields(entry_id)["is_post"]:
+                ids.append(entry_id)
+            entry_id -= 1
+        return ids
+
+    @staticmethod
+    def listing_page(entry_ids, more_link):
+        rows = []
+        for rank, entry_id in enumerate(entry_ids):
+            fields = StubHandler.item_fields(entry_id)
+            post_time = datetime.fromtimestamp(fields["time"], timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+            status = " [flagged]" if fields["flagged"] else ""
+            rows.append(
+                f'<tr class="athing submission" id="{entry_id}"><td align="right" valign="top" class="title"><span class="rank">{rank + 1}.</span></td>'
+                f'<td class="title"><span class="titleline"><a href="https://example.com/{entry_id}">Story number {entry_id}</a></span>{status}</td></tr>'
+                f'<tr><td colspan="2"></td><td class="subtext"><span class="score" id="score_{entry_id}">{fields["score"]} points</span>'
+                f' by <a href="user?id={fields["author"]}" class="hnuser">{fields["author"]}</a>'
+                f' <span class="age" title="{post_time} {fields["time"]}"><a href="item?id={entry_id}">1 hour ago</a></span>'
+                f' | <a href="item?id={entry_id}">{fields["comments"]}&nbsp;comments</a></td></tr>'
+            )
+        return f'<html><body><table id="hnmain">{"".join(rows)}</table>{more_link}</body></html>'
+
+
+def serve(args):
+    args.min_id = args.max_id - args.items
+    StubHandler.config = args
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    server.daemon_threads = True
+    print("serving hn stand-in on port", server.server_port, "entry ids", args.min_id + 1, "to", args.max_id, flush=True)
+    server.serve_forever()
+
+
+# wraps the fetcher of a crawler, keeps the latency of each request
+class TimedFetcher:
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.latencies = []
+
+    def fetch(self, url):
+        start = time.perf_counter()
+        ret = self.fetcher.fetch(url)
+        self.latencies.append(time.perf_counter() - start)
+        return ret
+
+    async def fetch_async(self, url):
+        start = time.perf_counter()
+        ret = await self.fetcher.fetch_async(url)
+        self.latencies.append(time.perf_counter() - start)
+        return ret
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+# latencies: of the fetches, None for a run that doesn't fetch
+def report(name, num_items, seconds, latencies, unit="items"):
+    line = f"{name:9}: {num_items} {unit} {seconds:.2f} sec {num_items / seconds:.1f} {unit}/sec"
+    if latencies is not None:
+        line += f" fetch p50: {1000 * percentile(latencies, 0.5):.1f}ms p99: {1000 * percentile(latencies, 0.99):.1f}ms"
+    print(line, flush=True)
+
+
+# the peak is of the whole process (all stages so far), not of one stage
+def report_peak_rss():
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"peak rss : {peak_rss:.1f}MB", flush=True)
+
+
+# drop and create the db of the benchmark (never the db of the crawler). The DBLayer instances must be closed:
+# their connections are closed here, the db can't be dropped while there are connections to it
+def fresh_db(args, dbparams):
+    if args.storage == "sqlite":
+        drop_db(args, dbparams)
+        return
+    crawl.DBLayer.close_pools()
+    conn = psycopg2.connect(dbname='postgres', user=args.user, host=args.host)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{args.db}"')
+        cursor.execute(f'CREATE DATABASE "{args.db}"')
+    conn.close()
+
+
+def drop_db(args, dbparams):
+    if args.storage == "sqlite":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(dbparams['sqlite_path'] + suffix):
+                os.remove(dbparams['sqlite_path'] + suffix)
+        return
+    crawl.DBLayer.close_pools()
+    conn = psycopg2.connect(dbname='postgres', user=args.user, host=args.host)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{args.db}"')
+    conn.close()
+
+
+def start_stub_server(args):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    cmd = [ sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--items", str(args.items),
+            "--max-id", str(args.max_id), "--latency", str(args.latency), "--error-rate", str(args.error_rate) ]
+    if args.corpus:
+        cmd += [ "--corpus", args.corpus ]
+    server = subprocess.Popen(cmd)
+
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, port
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    print("Error: the stub server did not start")
+    sys.exit(1)
+
+
+# run the crawlers and the formatter against the stub server and a throwaway db
+def bench_e2e(args):
+    server, port = start_stub_server(args)
+    # with sqlite: the file <db>.sqlite in the current directory
+    dbparams = { 'dbname': args.db, 'user': args.user, 'host': args.host, 'pass': '',
+                 'storage': args.storage, 'sqlite_path': os.path.abspath(args.db + ".sqlite") }
+    fetchparams = {
+        'backend': 'http',
+        'timeout': 30.0,
+        'retries': 3,
+        'source': args.source,
+        'hn_url': f"http://127.0.0.1:{port}",
+        'api_url': f"http://127.0.0.1:{port}/v0",
+        'cache_dir': ""
+    }
+    start_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="bench-format-")
+
+    try:
+        # crawl of an entry id range
+        fresh_db(args, dbparams)
+        crawler = crawl.HHCrawlerOnEntryIdRange(False, args.max_id, args.max_id - args.items, dbparams, fetchparams)
+        crawler.dblayer.make_tbl()
+        crawler.crawl.fetcher = TimedFetcher(crawler.crawl.fetcher)
+        start = time.perf_counter()
+        crawler.scan(args.concurrency, args.rate)
+        report("crawl", args.items, time.perf_counter() - start, crawler.crawl.fetcher.latencies)
+        crawler.dblayer.close()
+
+        # format the site from the crawled posts
+        os.chdir(work_dir)
+        page = crawl.FormatPage(False, dbparams, jobs=args.jobs)
+        start = time.perf_counter()
+        page.format()
+        report("format", page.pages_written, time.perf_counter() - start, None, "pages")
+        page.dblayer.close()
+
+        # crawl following the newest listing pages (in an empty db)
+        fresh_db(args, dbparams)
+        crawler = crawl.HNCrawlerFollowNextPage(False, dbparams, fetchparams)
+        crawler.dblayer.make_tbl()
+        crawler.crawl.fetcher = TimedFetcher(crawler.crawl.fetcher)
+        num_fetched = crawl.metrics.counters["items_fetched"]
+        start = time.perf_counter()
+        crawler.scan(args.pages + 1, crawl.HNCrawlerUtil.TAB_NEWEST)
+        # posts come from the listing pages, the item page is fetched only for some
+        num_items = crawl.metrics.counters["from_listing"] + crawl.metrics.counters["items_fetched"] - num_fetched
+        report("oldcrawl", num_items, time.perf_counter() - start, crawler.crawl.fetcher.latencies)
+        crawler.dblayer.close()
+        report_peak_rss()
+    finally:
+        server.terminate()
+        server.wait()
+        os.chdir(start_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not args.keep_db:
+            drop_db(args, dbparams)
+
+
+def parse_cmd_line():
+
+    usage = """
+Benchmarks for the 'hacker news - red flag eddition' crawler
+"""
+    parent_parser = argparse.ArgumentParser(
+        description=usage, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    subparsers = parent_parser.add_subparsers(dest='command')
+
+    parser = subparsers.add_parser('parse', help='compare item page parsers (speed and equal output) on saved item pages')
+
+    parser.add_argument(
+        "dir",
+        type=str,
+        help="directory with saved item pages (*.html)"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        "-r",
+        default=20,
+        type=int,
+        dest="repeat",
+        help="number of times each page is parsed"
+    )
+
+    def add_stub_args(parser):
+        parser.add_argument(
+            "--items",
+            "-i",
+            default=2000,
+            type=int,
+            dest="items",
+            help="number of entry ids served (the highest ones up to --max-id)"
+        )
+
+        parser.add_argument(
+            "--max-id",
+            default=30000000,
+            type=int,
+            dest="max_id",
+            help="highest entry id"
+        )
+
+        parser.add_argument(
+            "--latency",
+            "-l",
+            default=50.0,
+            type=float,
+            dest="latency",
+            help="average latency of a response in milliseconds (each one is between half and one and a half of it)"
+        )
+
+        parser.add_argument(
+            "--error-rate",
+            "-e",
+            default=0.0,
+            type=float,
+            dest="error_rate",
+            help="fraction of requests that are answered with 503 or the throttle page"
+        )
+
+        parser.add_argument(
+            "--corpus",
+            default="",
+            type=str,
+            dest="corpus",
+            help="directory with recorded pages (<id>.html item pages, <id>.json api items), served instead of made up ones"
+        )
+
+    parser = subparsers.add_parser('serve', help='run the local hn stand-in server (item pages, listing pages, json api)')
+
+    add_stub_args(parser)
+
+    parser.add_argument(
+        "--port",
+        default=8080,
+        type=int,
+        dest="port",
+        help="port of the server"
+    )
+
+    parser = subparsers.add_parser('e2e', help='run the crawlers and the formatter against the stand-in server and a throwaway db')
+
+    add_stub_args(parser)
+
+    parser.add_argument(
+        "--pages",
+        default=5,
+        type=int,
+        dest="pages",
+        help="number of listing pages for the oldcrawl run"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        default=8,
+        type=int,
+        dest="concurrency",
+        help="number of item fetches in flight for the crawl run"
+    )
+
+    parser.add_argument(
+        "--rate",
+        "-r",
+        default=0.0,
+        type=float,
+        dest="rate",
+        help="maximum number of requests per second (0 - no limit)"
+    )
+
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        default=1,
+        type=int,
+        dest="jobs",
+        help="number of processes that render pages in the format run"
+    )
+
+    parser.add_argument(
+        "--source",
+        default="html",
+        choices=["html", "api"],
+        dest="source",
+        help="crawl item pages or the json api"
+    )
+
+    parser.add_argument(
+        "--db",
+        "-b",
+        default="rf-hn-bench",
+        type=str,
+        dest="db",
+        help="name of the throwaway db (dropped and created for each run)"
+    )
+
+    parser.add_argument(
+        "--storage",
+        default="postgres",
+        choices=["postgres", "sqlite"],
+        dest="storage",
+        help="postgres - the db --db on --host, sqlite - the file <db>.sqlite in the current directory"
+    )
+
+    parser.add_argument(
+        "--user",
+        "-u",
+        default=os.getenv("USER"),
+        type=str,
+        dest="user",
+        help="db user"
+    )
+
+    parser.add_argument(
+        "--host",
+        "-n",
+        default="localhost",
+        type=str,
+        dest="host",
+        help="db host"
+    )
+
+    parser.add_argument(
+        "--keep-db",
+        default=False,
+        action="store_true",
+        dest="keep_db",
+        help="don't drop the db at the end"
+    )
+
+    return parent_parser.parse_args()
+
+
+def run_bench():
+    args = parse_cmd_line()
+
+    if args.command == "parse":
+        bench_parse(args)
+    elif args.command == "serve":
+        serve(args)
+    elif args.command == "e2e":
+        bench_e2e(args)
+    else:
+        print("Error: no action specified")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_bench()
@@ -2,20 +2,282 @@
 import os
 import re
 import sys
-from datetime import datetime
+import time
+import gzip
+import json
+import random
+import hashlib
+import html
+import zlib
+import asyncio
+import collections
+import functools
+import contextlib
+import threading
+import socket
+import concurrent.futures
+import http.client
+import urllib.parse
+import sqlite3
+from datetime import datetime, timedelta, timezone
 import argparse
 import getpass
 import subb
 import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
+import psycopg2.errors
+
+# optional, only needed for the export subcommand
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# counters and per stage timers of the crawler and the formatter. There is one instance (metrics, below);
+# a summary line is printed every report_interval seconds, and written to a text file in the
+# prometheus exposition format (for the textfile collector of node_exporter), if one is given.
+class Metrics:
+    # upper bounds of the latency buckets, in seconds
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    PREFIX = "flagged_hn"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        # stage name -> [bucket counts (last one is +Inf), sum of seconds, number of observations]
+        self.stages = {}
+        self.start_time = time.time()
+        self.report_interval = 0
+        self.prometheus_file = ""
+        self.next_report = 0.0
+        self.last_report = (self.start_time, 0)
+
+    def configure(self, report_interval, prometheus_file):
+        self.report_interval = report_interval
+        self.prometheus_file = prometheus_file
+        self.next_report = time.time() + report_interval
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = [[0] * (len(Metrics.LATENCY_BUCKETS) + 1), 0.0, 0]
+            buckets, _, _ = stage_stats = self.stages[stage]
+            pos = 0
+            while pos < len(Metrics.LATENCY_BUCKETS) and seconds > Metrics.LATENCY_BUCKETS[pos]:
+                pos += 1
+            buckets[pos] += 1
+            stage_stats[1] += seconds
+            stage_stats[2] += 1
+
+    # a post was checked: rec is the db record before the check (None for a new post)
+    @staticmethod
+    def count_checked(rec, changed):
+        if rec is None:
+            metrics.count("inserted")
+        elif changed:
+            metrics.count("updated")
+        else:
+            metrics.count("unchanged")
 
-
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def report_if_due(self):
+        if self.report_interval > 0 and time.time() >= self.next_report:
+            self.next_report = time.time() + self.report_interval
+            self.report()
+
+    def report(self):
+        if not self.counters and not self.stages:
+            return
+        print(self.summary_line())
+        if self.prometheus_file:
+            PageCache.write_file(self.prometheus_file, self.prometheus_text().encode("utf-8"))
+
+    # upper bound of the bucket that has the given fraction of the observations (approximates the percentile)
+    @staticmethod
+    def percentile(buckets, num, fraction):
+        seen = 0
+        for pos, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= fraction * num:
+                return Metrics.LATENCY_BUCKETS[pos] if pos < len(Metrics.LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+    def summary_line(self):
+        now = time.time()
+        with self.lock:
+            items = self.counters["items_fetched"]
+            last_time, last_items = self.last_report
+            self.last_report = (now, items)
+            parts = [f"items: {items} ({(items - last_items) / max(now - last_time, 1e-6):.1f}/sec)"]
+            for stage, (buckets, total, num) in sorted(self.stages.items()):
+                parts.append(f"{stage}: {num} avg {1000 * total / num:.0f}ms p50 <{Metrics.percentile(buckets, num, 0.5)}s p99 <{Metrics.percentile(buckets, num, 0.99)}s")
+            parts.extend(f"{name}: {value}" for name, value in sorted(self.counters.items()) if name != "items_fetched")
+        return "metrics: " + " | ".join(parts)
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {Metrics.PREFIX}_{name}_total counter")
+                lines.append(f"{Metrics.PREFIX}_{name}_total {value}")
+
+            name = f"{Metrics.PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, (buckets, total, num) in sorted(self.stages.items()):
+                seen = 0
+                for bound, bucket_count in zip(Metrics.LATENCY_BUCKETS + ("+Inf",), buckets):
+                    seen += bucket_count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {seen}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {num}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# connection of the pool, remembers the statements that were prepared on it (they live as long as the connection)
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# each DBLayer has a connection from a pool, there is one pool per db for the whole process: DBLayer instances
+# for different threads (or different parts of the program) don't share a connection, and don't connect again.
+# If the connection is lost (db restart, network), with_reconnect gets a new one and runs the transaction again.
 class DBLayer:
+    # the connections of each pool
+    POOL_SIZE = 8
+
+    # number of times to reconnect, before giving up
+    RECONNECT_TRIES = 5
+
+    # with db --partition: entry ids per partition of the posts table
+    PARTITION_SIZE = 1000000
+
+    # the indexes of the posts table that make_tbl creates (the ones that came later are in upgrade_tbl)
+    POST_INDEXES = (
+        "create index posts_status on posts(status)",
+        "create index posts_tab on posts(tab)",
+        "create index posts_created_at on posts(created_at)",
+    )
+
+    # hot reads, prepared on each connection the first time they are used (parameters: $1, $2, ...). The posts are
+    # written with the batched upsert of upsert_posts
+    PREPARED = {
+        "find_posts": "SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost, last_checked_at, next_check_at FROM posts pst WHERE pst.entryid = ANY($1)",
+        "find_posts_range": "SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost, last_checked_at, next_check_at FROM posts pst WHERE pst.entryid <= $1 AND pst.entryid > $2",
+        "find_due_posts": "SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost, last_checked_at, next_check_at FROM posts pst WHERE pst.next_check_at <= now() ORDER BY pst.next_check_at LIMIT $1",
+    }
+
+    pools = {}
+    pools_lock = threading.Lock()
+
     def __init__(self, verbose, dbparams):
-        self.conn = psycopg2.connect(
-            f"dbname='{dbparams['dbname']}' user='{dbparams['user']}' host='{dbparams['host']}' password='{dbparams['pass']}'"
-        )
-        self.cursor = self.conn.cursor()
         self.verbose = verbose
+        self.pool = DBLayer.get_pool(dbparams)
+        self.conn = None
+        self.cursor = None
+        # partitions of the posts table: None - not known yet, 0 - posts is not partitioned
+        self.partition_size = None
+        self.partitions_to = None
+        self.connect()
+
+    @staticmethod
+    def get_pool(dbparams):
+        key = (dbparams['dbname'], dbparams['user'], dbparams['host'])
+        with DBLayer.pools_lock:
+            if key not in DBLayer.pools:
+                DBLayer.pools[key] = psycopg2.pool.ThreadedConnectionPool(
+                    1,
+                    DBLayer.POOL_SIZE,
+                    dbname=dbparams['dbname'],
+                    user=dbparams['user'],
+                    host=dbparams['host'],
+                    password=dbparams['pass'],
+                    connection_factory=PooledConnection
+                )
+            return DBLayer.pools[key]
+
+    def connect(self):
+        self.conn = self.pool.getconn()
+        self.cursor = self.conn.cursor()
+
+    # drop the connection (it is broken) and get another one
+    def reconnect(self):
+        try:
+            self.pool.putconn(self.conn, close=True)
+        except psycopg2.Error:
+            pass
+        # the partitions are counted again on the new connection
+        self.partition_size = None
+        self.connect()
+
+    # give the connection back to the pool (each DBLayer holds one connection until then)
+    def close(self):
+        if self.conn is not None:
+            self.pool.putconn(self.conn)
+        self.conn = None
+        self.cursor = None
+
+    # close all connections of all pools (after the DBLayer instances are closed), for example before the db is dropped
+    @staticmethod
+    def close_pools():
+        with DBLayer.pools_lock:
+            for pool in DBLayer.pools.values():
+                pool.closeall()
+            DBLayer.pools.clear()
+
+    # health check: reconnects if the connection doesn't work (for long running loops, that are idle for a while)
+    def check_connection(self):
+        def ping():
+            self.cursor.execute("SELECT 1")
+            self.conn.commit()
+        self.with_reconnect(ping)
+
+    # runs fn; if the connection to the db was lost, reconnects (with increasing delays) and runs fn again.
+    # fn must be a whole transaction, or the start of one: what was done before fn in the same transaction is lost
+    def with_reconnect(self, fn):
+        for attempt in range(DBLayer.RECONNECT_TRIES + 1):
+            try:
+                return fn()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                # an OperationalError on a connection that is still open is an error of the statement
+                # (canceled query, deadlock, ...), not a lost connection: running it again won't help
+                if attempt == DBLayer.RECONNECT_TRIES or (self.conn.closed == 0 and not isinstance(err, psycopg2.InterfaceError)):
+                    raise
+                delay = min(30, 2 ** attempt)
+                print("lost the db connection:", str(err).strip(), "- reconnect in", delay, "seconds")
+                time.sleep(delay)
+                try:
+                    self.reconnect()
+                except psycopg2.OperationalError as connect_err:
+                    print("reconnect failed:", str(connect_err).strip())
+
+    # run one of the PREPARED statements
+    def execute_prepared(self, name, params):
+        if name not in self.conn.prepared:
+            self.cursor.execute(f"PREPARE {name} AS {DBLayer.PREPARED[name]}")
+            self.conn.prepared.add(name)
+        self.cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
 
     def make_tbl(self):
         print("creating db tables...")
@@ -35,36 +297,147 @@ class DBLayer:
         print(create_query)
         self.cursor.execute(create_query)
 
-        create_index = "create index posts_status on posts(status)"
-        print(create_index)
-        self.cursor.execute(create_index)
-
-        create_index = "create index posts_tab on posts(tab)"
-        print(create_index)
-        self.cursor.execute(create_index)
-
-        create_index = "create index posts_created_at on posts(created_at)"
-        print(create_index)
-        self.cursor.execute(create_index)
+        for create_index in DBLayer.POST_INDEXES:
+            print(create_index)
+            self.cursor.execute(create_index)
 
         self.conn.commit()
         print("db tables created!")
 
-    def find_non_active(self, ispost):
-        self.cursor.execute(
-            """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.status <> 1 AND pst.ispost is %s ORDER BY pst.created_at DESC""", (ispost,)
+        self.upgrade_tbl()
+
+    # migration: replaces the posts table by a table that is partitioned by entry id range (partition_size entry ids
+    # each), with the same columns and indexes (each partition has its own). The primary key stays entryid, so that
+    # the upserts don't change; partitions for new entry ids are added by add_partitions. Copies all posts in one
+    # transaction - stop the crawlers while it runs.
+    def partition_tbl(self, partition_size):
+        self.upgrade_tbl()
+
+        self.cursor.execute("""SELECT relkind FROM pg_class WHERE oid = 'posts'::regclass""")
+        if self.cursor.fetchone()[0] == 'p':
+            print("posts table is partitioned already")
+            return
+
+        max_entry_id = self.max_entry_id()
+
+        print("partitioning posts table...")
+        queries = [ "CREATE TABLE posts_partitioned (LIKE posts INCLUDING DEFAULTS) PARTITION BY RANGE (entryid)",
+                    "ALTER TABLE posts_partitioned ADD PRIMARY KEY (entryid)" ]
+        queries += DBLayer.partition_queries("posts_partitioned", 0, DBLayer.partitions_end(max_entry_id, partition_size), partition_size)
+        queries += [ "INSERT INTO posts_partitioned SELECT * FROM posts",
+                     "DROP TABLE posts",
+                     "ALTER TABLE posts_partitioned RENAME TO posts",
+                     "ALTER TABLE posts RENAME CONSTRAINT posts_partitioned_pkey TO posts_pkey" ]
+        queries += DBLayer.POST_INDEXES
+        for query in queries:
+            print(query)
+            self.cursor.execute(query)
+        self.save_crawl_state("partitions", { "size": partition_size })
+        self.conn.commit()
+        print("posts table partitioned!")
+
+        # the indexes of upgrade_tbl
+        self.upgrade_tbl()
+
+    # end of the partitions that are needed for max_entry_id: one partition more than that, so that a partition is
+    # rarely added by a crawl
+    @staticmethod
+    def partitions_end(max_entry_id, partition_size):
+        return (max_entry_id // partition_size + 2) * partition_size
+
+    @staticmethod
+    def partition_queries(table, partitions_from, partitions_to, partition_size):
+        return [ f"CREATE TABLE IF NOT EXISTS posts_p{start // partition_size} PARTITION OF {table} FOR VALUES FROM ({start}) TO ({start + partition_size})"
+                 for start in range(partitions_from, partitions_to, partition_size) ]
+
+    # adds partitions to a partitioned posts table, up to the one after max_entry_id. Called ahead of the upserts
+    # that need them (PostWriter.flush, db --upgrade), outside of their transaction: creating a partition locks the whole
+    # posts table, so each one is created and committed on its own. Another crawler may create the same partition
+    # at the same time, that one wins.
+    def add_partitions(self, max_entry_id):
+        if self.partition_size is None:
+            state = self.load_crawl_state("partitions")
+            self.partition_size = 0 if state is None else state["size"]
+            if self.partition_size != 0:
+                self.cursor.execute("""SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'posts'::regclass""")
+                self.partitions_to = self.cursor.fetchone()[0] * self.partition_size
+        if self.partition_size == 0 or max_entry_id < self.partitions_to - self.partition_size:
+            return
+        partitions_to = DBLayer.partitions_end(max_entry_id, self.partition_size)
+        for query in DBLayer.partition_queries("posts", self.partitions_to, partitions_to, self.partition_size):
+            print(query)
+            try:
+                self.cursor.execute(query)
+                self.conn.commit()
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                self.conn.rollback()
+        self.partitions_to = partitions_to
+
+    def max_entry_id(self):
+        self.cursor.execute("""SELECT MAX(entryid) FROM posts""")
+        return self.cursor.fetchone()[0] or 0
+
+    # adds what was added to the schema after the posts table, to a new or to an existing db.
+    # (each statement can run more than once)
+    def upgrade_tbl(self):
+        print("upgrading db tables...")
+        for query in (
+            "ALTER TABLE posts ADD COLUMN IF NOT EXISTS last_checked_at TIMESTAMPTZ",
+            "ALTER TABLE posts ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMPTZ",
+            "CREATE INDEX IF NOT EXISTS posts_next_check_at ON posts(next_check_at) WHERE next_check_at IS NOT NULL",
+            "CREATE TABLE IF NOT EXISTS crawl_state(name VARCHAR(64) PRIMARY KEY NOT NULL, state TEXT, updated_at TIMESTAMPTZ)",
+            # shard covers shard_from >= entryid > shard_to, state: 0 - open, 1 - claimed, 2 - done
+            "CREATE TABLE IF NOT EXISTS crawl_shards(shard_from BIGINT PRIMARY KEY NOT NULL, shard_to BIGINT NOT NULL, watermark BIGINT NOT NULL, state INTEGER NOT NULL, worker VARCHAR(128), lease_until TIMESTAMPTZ)",
+            "CREATE INDEX IF NOT EXISTS crawl_shards_state ON crawl_shards(state, lease_until)",
+            # history of the posts, rows are only added. prev_status is NULL for the first time a post was seen
+            "CREATE TABLE IF NOT EXISTS post_events(entryid BIGINT NOT NULL, event_at TIMESTAMPTZ NOT NULL, status INTEGER, nscore INTEGER, ncomments INTEGER, prev_status INTEGER)",
+            "CREATE INDEX IF NOT EXISTS post_events_entryid ON post_events(entryid, event_at)",
+            # for find_non_active: the flagged/deleted posts (a small part of the table) in the order of the site,
+            # with the small columns it reads. Not the title: a title with a long url would not fit into an index row
+            # (the first version of the index had it)
+            "DROP INDEX IF EXISTS posts_non_active",
+            "CREATE INDEX IF NOT EXISTS posts_non_active_v2 ON posts(ispost, created_at DESC) INCLUDE (entryid, tab, nscore, ncomments, author, status) WHERE status <> 1",
+            # id of the transaction that wrote the post last (upsert_posts), for the incremental export
+            "ALTER TABLE posts ADD COLUMN IF NOT EXISTS change_id BIGINT",
+            "CREATE INDEX IF NOT EXISTS posts_change_id ON posts(change_id)",
+        ):
+            print(query)
+            self.cursor.execute(query)
+        self.conn.commit()
+        print("db tables upgraded!")
+
+    # yields the rows one after the other. The rows come from a server side cursor, in batches of itersize rows,
+    # so that the whole result is never in memory.
+    def find_non_active(self, ispost, itersize=2000):
+        return self.iter_query(
+            "find_non_active",
+            """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.status <> 1 AND pst.ispost = %s ORDER BY pst.created_at DESC""", (ispost,),
             #"""SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.status <> 1 ORDER BY pst.created_at"""
+            itersize
         )
-        return self.cursor.fetchall()
+
+    # yields the rows of query from a server side cursor (name), itersize rows at a time
+    def iter_query(self, name, query, params, itersize):
+        with self.conn.cursor(name=name) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        # server side cursors live in a transaction
+        self.conn.commit()
+
+    # runs an INSERT with "VALUES %s" for all rows, page_size rows per statement (template: the sql of one row)
+    def execute_values(self, query, rows, template=None):
+        psycopg2.extras.execute_values(self.cursor, query, rows, template=template, page_size=1000)
 
     def find_post_latest(self, latest):
         if latest:
             self.cursor.execute(
-                """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.created_at = (SELECT MAX(created_at) from posts)"""
+                """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.created_at IS NOT NULL ORDER BY pst.created_at DESC LIMIT 1"""
             )
         else:
             self.cursor.execute(
-                """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.created_at = (SELECT MIN(created_at) from posts)"""
+                """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.created_at IS NOT NULL ORDER BY pst.created_at LIMIT 1"""
             )
         ret = self.cursor.fetchall()
         if self.verbose:
@@ -75,36 +448,405 @@ class DBLayer:
 
 
 
-    def find_post(self, entry_id):
+    # returns map of entry id to post record, for all entry ids in the list that are in the db
+    def find_posts(self, entry_ids):
+        with metrics.timer("db_read"):
+            rows = self.with_reconnect(lambda: self.fetch_prepared("find_posts", ([int(entry_id) for entry_id in entry_ids],)))
+            return { row[0] : DBLayer.row_to_rec(row) for row in rows }
+
+    # returns map of entry id to post record, for all posts with entry_id_to < entryid <= entry_id_from
+    def find_posts_range(self, entry_id_from, entry_id_to):
+        with metrics.timer("db_read"):
+            rows = self.with_reconnect(lambda: self.fetch_prepared("find_posts_range", (entry_id_from, entry_id_to)))
+            return { row[0] : DBLayer.row_to_rec(row) for row in rows }
+
+    @staticmethod
+    def row_to_rec(row):
+        return {
+            "entry_id": row[0],
+            "tab": row[1],
+            "title": row[2],
+            "nscore": int(row[3]),
+            "ncomments": int(row[4]),
+            "author": row[5],
+            "created_at": row[6],
+            "status": int(row[7]),
+            "ispost": row[8],
+            "last_checked_at": row[9],
+            "next_check_at": row[10]
+        }
+
+    # posts that are due for a recheck, the ones that are due the longest come first
+    def find_due_posts(self, limit):
+        with metrics.timer("db_read"):
+            rows = self.with_reconnect(lambda: self.fetch_prepared("find_due_posts", (limit,)))
+            return [ DBLayer.row_to_rec(row) for row in rows ]
+
+    def fetch_prepared(self, name, params):
+        self.execute_prepared(name, params)
+        return self.cursor.fetchall()
+
+    # insert or update a batch of rows (tuples in the order of PostWriter.row) with one statement and one commit
+    def upsert_posts(self, rows, commit=True):
+        if self.verbose:
+            print("upsert", len(rows), "post records")
+        with metrics.timer("db_write"):
+            self.execute_values(
+                """INSERT INTO posts (entryid, tab, title, nscore, ncomments, author, created_at, status, ispost, last_checked_at, next_check_at, change_id) VALUES %s ON CONFLICT (entryid) DO UPDATE SET (tab, title, nscore, ncomments, author, created_at, status, ispost, last_checked_at, next_check_at, change_id) = (EXCLUDED.tab, EXCLUDED.title, EXCLUDED.nscore, EXCLUDED.ncomments, EXCLUDED.author, EXCLUDED.created_at, EXCLUDED.status, EXCLUDED.ispost, EXCLUDED.last_checked_at, EXCLUDED.next_check_at, EXCLUDED.change_id)""",
+                rows,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, txid_current())"
+            )
+        if commit:
+            self.commit()
+
+    # retention: active comments are not shown on the site, their title is dropped once they are older than
+    # cutoff (the rest of the row stays, for the crawler). cutoff must be at least RecheckScheduler.MAX_AGE ago:
+    # older comments are not checked again, their status stays active - a title that is dropped can't be needed
+    # later on. One transaction per batch_size entry ids, to keep the locks short.
+    def prune_comments(self, cutoff, batch_size):
+        self.cursor.execute("""SELECT MIN(entryid), MAX(entryid) FROM posts""")
+        min_entry_id, max_entry_id = self.cursor.fetchone()
+        if min_entry_id is None:
+            return 0
+        num_pruned = 0
+        for batch_to in range(min_entry_id - 1, max_entry_id, batch_size):
+            def prune():
+                self.cursor.execute(
+                    """UPDATE posts SET title = NULL WHERE entryid > %s AND entryid <= %s AND NOT ispost AND status = 1 AND title IS NOT NULL AND created_at < %s""",
+                    (batch_to, batch_to + batch_size, cutoff)
+                )
+                num_rows = self.cursor.rowcount
+                self.conn.commit()
+                return num_rows
+            num_pruned += self.with_reconnect(prune)
+            if self.verbose:
+                print("pruned comments up to entry id:", batch_to + batch_size, "total:", num_pruned)
+        return num_pruned
+
+    # add rows (tuples in the order of PostWriter.add_event) to the history of the posts, doesn't commit
+    def insert_events(self, events):
+        with metrics.timer("db_write"):
+            self.execute_values(
+                """INSERT INTO post_events (entryid, event_at, status, nscore, ncomments, prev_status) VALUES %s""",
+                events
+            )
+
+    # how long it takes until a post is flagged: seconds from created_at until the first check that found it flagged
+    # (an upper bound, it depends on how often the post was checked). Only for posts that were seen active before.
+    # returns rows of (ispost, number of posts, median, 90th percentile, average)
+    def flag_stats(self):
         self.cursor.execute(
-            """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost FROM posts pst WHERE pst.entryid = %s""", (entry_id,)
+            """SELECT pst.ispost, COUNT(*), PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY flg.seconds), PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY flg.seconds), AVG(flg.seconds)
+               FROM (SELECT entryid, MIN(event_at) AS flagged_at FROM post_events WHERE status = 2 GROUP BY entryid) evt
+               JOIN posts pst ON pst.entryid = evt.entryid
+               CROSS JOIN LATERAL (SELECT EXTRACT(EPOCH FROM evt.flagged_at - pst.created_at) AS seconds) flg
+               WHERE EXISTS (SELECT 1 FROM post_events act WHERE act.entryid = evt.entryid AND act.status = 1 AND act.event_at < evt.flagged_at)
+               GROUP BY pst.ispost ORDER BY pst.ispost DESC"""
         )
-        rows = self.cursor.fetchall()
+        return self.cursor.fetchall()
 
-        if len(rows) != 0:
-            if self.verbose:
-                print("key: ", entry_id, "found entry: ", rows)
-            row = rows[0]
-            return {
-                "entry_id": row[0],
-                "tab": row[1],
-                "title": row[2],
-                "nscore": int(row[3]),
-                "ncomments": int(row[4]),
-                "author": row[5],
-                "created_at": row[6],
-                "status": int(row[7]),
-                "ispost": row[8]
-            }
+    def db_now(self):
+        self.cursor.execute("""SELECT now()""")
+        return self.cursor.fetchone()[0]
 
-        return None
+    # posts that are written after this call have a change_id >= the returned value: the oldest transaction that
+    # was still running (a post that it writes can be committed after the export read the posts)
+    def export_change_id(self):
+        self.cursor.execute("""SELECT txid_snapshot_xmin(txid_current_snapshot())""")
+        return self.cursor.fetchone()[0]
+
+    # months (first day, UTC) with posts that were written with change_id >= since (all months if since is None)
+    def find_export_months(self, since):
+        if since is None:
+            self.cursor.execute(
+                """SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') FROM posts WHERE created_at IS NOT NULL"""
+            )
+        else:
+            self.cursor.execute(
+                """SELECT DISTINCT date_trunc('month', pst.created_at AT TIME ZONE 'UTC') FROM posts pst WHERE pst.change_id >= %s AND pst.created_at IS NOT NULL""", (since,)
+            )
+        return sorted(self.month_value(row[0]) for row in self.cursor.fetchall())
+
+    # the month of find_export_months (timestamp without time zone, in UTC)
+    @staticmethod
+    def month_value(value):
+        return value.replace(tzinfo=timezone.utc)
+
+    # yields the posts with month_start <= created_at < month_end, from a server side cursor (like find_non_active)
+    def find_posts_created(self, month_start, month_end, itersize=10000):
+        return self.iter_query(
+            "find_posts_created",
+            """SELECT entryid, tab, title, nscore, ncomments, author, created_at, status, ispost, last_checked_at FROM posts pst WHERE pst.created_at >= %s AND pst.created_at < %s ORDER BY pst.entryid""", (month_start, month_end),
+            itersize
+        )
+
+    def commit(self):
+        with metrics.timer("db_commit"):
+            self.conn.commit()
+
+    # state of a crawler (json), None if there is none
+    def load_crawl_state(self, name):
+        def load():
+            self.cursor.execute("""SELECT state FROM crawl_state WHERE name = %s""", (name,))
+            return self.cursor.fetchall()
+        rows = self.with_reconnect(load)
+        if len(rows) == 0:
+            return None
+        return json.loads(rows[0][0])
+
+    SHARD_OPEN = 0
+    SHARD_CLAIMED = 1
+    SHARD_DONE = 2
+
+    # shards: list of (shard_from, shard_to); shards that exist already are left alone
+    def create_shards(self, shards):
+        self.execute_values(
+            """INSERT INTO crawl_shards (shard_from, shard_to, watermark, state) VALUES %s ON CONFLICT (shard_from) DO NOTHING""",
+            [ (shard_from, shard_to, shard_from, DBLayer.SHARD_OPEN) for shard_from, shard_to in shards ]
+        )
+        self.conn.commit()
+
+    # claim an open shard, or a shard whose lease expired. Returns (shard_from, shard_to, watermark) or None.
+    # SKIP LOCKED: workers that claim at the same time get different shards, without waiting for each other
+    def claim_shard(self, worker, lease_seconds):
+        def claim():
+            self.cursor.execute(
+                """UPDATE crawl_shards SET state = %s, worker = %s, lease_until = now() + %s * interval '1 second' WHERE shard_from = (SELECT shard_from FROM crawl_shards WHERE state = %s OR (state = %s AND lease_until < now()) ORDER BY shard_from DESC LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING shard_from, shard_to, watermark""",
+                (DBLayer.SHARD_CLAIMED, worker, lease_seconds, DBLayer.SHARD_OPEN, DBLayer.SHARD_CLAIMED)
+            )
+            rows = self.cursor.fetchall()
+            self.conn.commit()
+            return rows
+        rows = self.with_reconnect(claim)
+        if len(rows) == 0:
+            return None
+        return rows[0]
+
+    # doesn't commit (called before the posts up to the watermark are committed).
+    # returns False if the shard is no longer claimed by this worker.
+    def update_shard(self, shard_from, worker, watermark, lease_seconds):
+        self.cursor.execute(
+            """UPDATE crawl_shards SET watermark = %s, lease_until = now() + %s * interval '1 second' WHERE shard_from = %s AND worker = %s AND state = %s""",
+            (watermark, lease_seconds, shard_from, worker, DBLayer.SHARD_CLAIMED)
+        )
+        return self.cursor.rowcount == 1
 
-    def insert_post(self, rec, tab):
+    def complete_shard(self, shard_from, worker):
+        def complete():
+            self.cursor.execute(
+                """UPDATE crawl_shards SET state = %s, watermark = shard_to, lease_until = NULL WHERE shard_from = %s AND worker = %s""",
+                (DBLayer.SHARD_DONE, shard_from, worker)
+            )
+            self.conn.commit()
+        self.with_reconnect(complete)
+
+    # (state, number of shards, number of entry ids left to crawl) for each state
+    def shard_status(self):
+        self.cursor.execute(
+            """SELECT state, COUNT(*), SUM(watermark - shard_to) FROM crawl_shards GROUP BY state ORDER BY state"""
+        )
+        return self.cursor.fetchall()
+
+    # doesn't commit: the state is written in the same transaction as the posts that it refers to.
+    def save_crawl_state(self, name, state):
         if self.verbose:
-            print("insert post record: ", rec, "tab:", tab)
-        insert_query = """INSERT INTO posts (entryid, tab, title, nscore, ncomments, author, created_at, status, ispost) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-        item_tuple = (
-            rec["entry_id"],
+            print("save crawl state:", name, state)
+        self.cursor.execute(
+            """INSERT INTO crawl_state (name, state, updated_at) VALUES (%s, %s, now()) ON CONFLICT (name) DO UPDATE SET (state, updated_at) = (EXCLUDED.state, EXCLUDED.updated_at)""",
+            (name, json.dumps(state))
+        )
+
+
+# cursor of SQLiteDBLayer: runs the (postgres) sql of DBLayer on sqlite. The bits of syntax that differ are
+# translated (SYNTAX, in this order), list parameters (for "= ANY(...)") are passed as json arrays.
+class SQLiteCursor:
+    SYNTAX = tuple((re.compile(pattern), replacement) for pattern, replacement in (
+        (r"%s", "?"),
+        (r"\$(\d+)", r"?\1"),
+        (r"= ANY\((\?\d*)\)", r"IN (SELECT value FROM json_each(\1))"),
+        (r"now\(\) \+ (\?) \* interval '1 second'", r"add_seconds(now(), \1)"),
+        (r"date_trunc\('month', ([\w.]+) AT TIME ZONE 'UTC'\)", r"month_start(\1)"),
+        # one writer at a time: the highest change_id so far + 1 grows in the order of the commits
+        (r"txid_current\(\)|txid_snapshot_xmin\(txid_current_snapshot\(\)\)", "(SELECT COALESCE(MAX(change_id), 0) + 1 FROM posts)"),
+        # no INCLUDE in sqlite, the columns are part of the key
+        (r"\) INCLUDE \(", ", "),
+        # one writer at a time: workers that claim a shard at the same time get different ones
+        (r" FOR UPDATE SKIP LOCKED", ""),
+    ))
+    ADD_COLUMN = re.compile(r"ALTER TABLE (\w+) ADD COLUMN IF NOT EXISTS (\w+) (.+)")
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def translate(query):
+        for pattern, replacement in SQLiteCursor.SYNTAX:
+            query = pattern.sub(replacement, query)
+        return query
+
+    def execute(self, query, params=()):
+        match = SQLiteCursor.ADD_COLUMN.fullmatch(query)
+        if match:
+            table, column, column_type = match.groups()
+            if column in [row[1] for row in self.cursor.execute(f"PRAGMA table_info({table})")]:
+                return self
+            query = f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+        self.cursor.execute(SQLiteCursor.translate(query), [json.dumps(param) if isinstance(param, list) else param for param in params])
+        return self
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(SQLiteCursor.translate(query), rows)
+        return self
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+# storage in an sqlite file (WAL mode), for small setups without a postgres server. Same tables, indexes and
+# queries as DBLayer (through SQLiteCursor). Times are stored as text in UTC (fixed width, so that they sort
+# right), and come back as timezone aware datetimes like with postgres.
+class SQLiteDBLayer(DBLayer):
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+    def __init__(self, verbose, dbparams):
+        self.verbose = verbose
+        self.path = dbparams['sqlite_path']
+        self.conn = None
+        self.cursor = None
+        self.partition_size = None
+        self.partitions_to = None
+        self.connect()
+
+    @staticmethod
+    def to_db_time(time_value):
+        if time_value.tzinfo is None:
+            time_value = time_value.replace(tzinfo=timezone.utc)
+        return time_value.astimezone(timezone.utc).strftime(SQLiteDBLayer.TIME_FORMAT)
+
+    @staticmethod
+    def from_db_time(data):
+        time_value = datetime.fromisoformat(data.decode("utf-8"))
+        if time_value.tzinfo is None:
+            time_value = time_value.replace(tzinfo=timezone.utc)
+        return time_value
+
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc)
+
+    def connect(self):
+        # other processes (workers) may write at the same time: wait for their transaction to finish
+        self.conn = sqlite3.connect(self.path, timeout=60, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # the functions that SQLiteCursor.SYNTAX translates to
+        self.conn.create_function("now", 0, lambda: SQLiteDBLayer.to_db_time(SQLiteDBLayer.now()))
+        self.conn.create_function("add_seconds", 2, lambda time_value, seconds: SQLiteDBLayer.to_db_time(datetime.fromisoformat(time_value) + timedelta(seconds=seconds)), deterministic=True)
+        self.conn.create_function("month_start", 1, lambda time_value: None if time_value is None else time_value[:7] + "-01 00:00:00.000000", deterministic=True)
+        self.cursor = SQLiteCursor(self.conn.cursor())
+
+    def reconnect(self):
+        self.conn.close()
+        self.connect()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.cursor = None
+
+    # no connection that can get lost
+    def check_connection(self):
+        pass
+
+    def with_reconnect(self, fn):
+        return fn()
+
+    # the statements of DBLayer.PREPARED, not prepared
+    def execute_prepared(self, name, params):
+        self.cursor.execute(DBLayer.PREPARED[name], params)
+
+    def iter_query(self, name, query, params, itersize):
+        cursor = SQLiteCursor(self.conn.cursor())
+        cursor.arraysize = itersize
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+        cursor.close()
+
+    def execute_values(self, query, rows, template=None):
+        if len(rows) == 0:
+            return
+        if template is None:
+            template = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+        self.cursor.executemany(query.replace("VALUES %s", "VALUES " + template), rows)
+
+    @staticmethod
+    def month_value(value):
+        return SQLiteDBLayer.from_db_time(value.encode("utf-8"))
+
+    def db_now(self):
+        return SQLiteDBLayer.now()
+
+    # like DBLayer.flag_stats, the percentiles are computed here
+    def flag_stats(self):
+        self.cursor.execute(
+            """SELECT pst.ispost, (julianday(evt.flagged_at) - julianday(pst.created_at)) * 86400
+               FROM (SELECT entryid, MIN(event_at) AS flagged_at FROM post_events WHERE status = 2 GROUP BY entryid) evt
+               JOIN posts pst ON pst.entryid = evt.entryid
+               WHERE EXISTS (SELECT 1 FROM post_events act WHERE act.entryid = evt.entryid AND act.status = 1 AND act.event_at < evt.flagged_at)"""
+        )
+        seconds = collections.defaultdict(list)
+        for ispost, num_seconds in self.cursor.fetchall():
+            seconds[bool(ispost)].append(num_seconds)
+
+        ret = []
+        for ispost in sorted(seconds, reverse=True):
+            values = sorted(seconds[ispost])
+            ret.append((ispost, len(values), SQLiteDBLayer.percentile_cont(values, 0.5), SQLiteDBLayer.percentile_cont(values, 0.9), sum(values) / len(values)))
+        return ret
+
+    # like PERCENTILE_CONT in postgres: interpolates between the two nearest values (values are sorted)
+    @staticmethod
+    def percentile_cont(values, fraction):
+        pos = fraction * (len(values) - 1)
+        low = int(pos)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+sqlite3.register_adapter(datetime, SQLiteDBLayer.to_db_time)
+sqlite3.register_converter("TIMESTAMPTZ", SQLiteDBLayer.from_db_time)
+sqlite3.register_converter("BOOLEAN", lambda data: data != b"0")
+
+
+def make_dblayer(verbose, dbparams):
+    if dbparams.get("storage") == "sqlite":
+        return SQLiteDBLayer(verbose, dbparams)
+    return DBLayer(verbose, dbparams)
+
+
+# buffers post records and writes them with DBLayer.upsert_posts, once there are max_rows records or
+# once max_seconds have passed since the last write. Call flush when done (or use as context manager)
+# on_flush is called before each commit, to write the crawl state in the same transaction as the posts.
+class PostWriter:
+    def __init__(self, dblayer, max_rows=500, max_seconds=30):
+        self.dblayer = dblayer
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.rows = {}
+        self.events = []
+        self.last_flush = time.monotonic()
+        self.on_flush = None
+
+    @staticmethod
+    def row(rec, tab):
+        return (
+            int(rec["entry_id"]),
             tab,
             rec["title"],
             rec["nscore"],
@@ -112,68 +854,580 @@ class DBLayer:
             rec["author"],
             rec["created_at"],
             rec["status"],
-            rec["ispost"]
+            rec["ispost"],
+            rec.get("last_checked_at"),
+            rec.get("next_check_at")
         )
-        self.cursor.execute(insert_query, item_tuple)
-        self.conn.commit()
 
-    def update_post(self, rec, tab):
-        update_query = """UPDATE posts SET (tab, title, nscore, ncomments, author, created_at, status, ispost) = (%s, %s, %s, %s, %s, %s, %s, %s) WHERE entryid = %s"""
-        item_tuple = (
-            tab,
-            rec["title"],
+    def add(self, rec, tab):
+        # the same entry can only appear once in a multi row upsert, the later version wins.
+        self.rows[int(rec["entry_id"])] = PostWriter.row(rec, tab)
+        # with on_flush, the crawler calls flush_if_due at points where its state matches the added posts
+        if self.on_flush is None:
+            self.flush_if_due()
+
+    # history of a post (table post_events): there is an event when a post is seen the first time (old_rec is None),
+    # and when its status, score or number of comments changed. Written in the same transaction as the posts.
+    def add_event(self, old_rec, rec):
+        if old_rec is not None and all(old_rec[name] == rec[name] for name in ("status", "nscore", "ncomments")):
+            return
+        self.events.append((
+            int(rec["entry_id"]),
+            rec.get("last_checked_at") or datetime.now(timezone.utc),
+            rec["status"],
             rec["nscore"],
             rec["ncomments"],
-            rec["author"],
-            rec["created_at"],
-            rec["status"],
-            rec["ispost"],
-            rec["entry_id"]
+            None if old_rec is None else old_rec["status"]
+        ))
+
+    def flush(self):
+        # partitions for the entry ids of the batch are created before it, not in its transaction
+        if self.rows:
+            self.dblayer.with_reconnect(lambda: self.dblayer.add_partitions(max(self.rows)))
+        # one transaction, it is written again if the connection to the db was lost
+        self.dblayer.with_reconnect(self.write_batch)
+        self.rows = {}
+        self.events = []
+        self.last_flush = time.monotonic()
+
+    def write_batch(self):
+        if self.rows:
+            self.dblayer.upsert_posts(list(self.rows.values()), commit=False)
+        if self.events:
+            self.dblayer.insert_events(self.events)
+        if self.on_flush is not None:
+            self.on_flush()
+        if self.rows or self.events or self.on_flush is not None:
+            self.dblayer.commit()
+
+    # also writes the crawl state every max_seconds, for crawlers that go on for a while without adding posts
+    def flush_if_due(self):
+        if len(self.rows) >= self.max_rows or time.monotonic() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+# on disk cache of raw pages. The page text is stored compressed, under the hash of its content (pages with
+# the same content are stored once); for each url there is a small json file with the hash of its page, the
+# ETag/Last-Modified headers of the response and the time it was fetched. The modification time of the json file
+# is the time the page was last used: when the cache gets bigger than max_bytes, the least recently used urls
+# are dropped, together with the pages that no url refers to anymore.
+class PageCache:
+    # once the cache is bigger than max_bytes, evict drops pages until it is at this fraction of max_bytes: the cache
+    # directory is scanned again after (1 - EVICT_TO) * max_bytes of new pages, not after each page.
+    EVICT_TO = 0.9
+
+    # only item pages and api items are cached: the listings and the highest entry id change all the time
+    CACHEABLE_PATH = re.compile(r"/item(/\d+\.json)?$")
+
+    def __init__(self, verbose, cache_dir, ttl, max_bytes):
+        self.verbose = verbose
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # bytes of the pages in the cache: counted by the first evict, then kept up to date by store
+        self.total_bytes = None
+        self.evicting = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_cacheable(url_path):
+        return PageCache.CACHEABLE_PATH.search(url_path) is not None
+
+    @staticmethod
+    def hash_of(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def url_path(self, url):
+        url_hash = PageCache.hash_of(url.encode("utf-8"))
+        return os.path.join(self.cache_dir, "urls", url_hash[:2], url_hash + ".json")
+
+    def page_path(self, page_hash):
+        return os.path.join(self.cache_dir, "pages", page_hash[:2], page_hash + ".gz")
+
+    # the cache entry of the url (None if not cached)
+    def lookup(self, url):
+        try:
+            with open(self.url_path(url), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    # the page can be used without asking the server
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    # text of the page of a cache entry (None if the page is gone)
+    def read(self, entry):
+        try:
+            with open(self.page_path(entry["hash"]), "rb") as file:
+                data = gzip.decompress(file.read())
+            os.utime(self.url_path(entry["url"]))
+        except (OSError, EOFError, zlib.error):
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def store(self, url, text, etag, last_modified):
+        data = text.encode("utf-8")
+        page_hash = PageCache.hash_of(data)
+        page_path = self.page_path(page_hash)
+        added_bytes = 0
+        if not os.path.exists(page_path):
+            compressed = gzip.compress(data)
+            PageCache.write_file(page_path, compressed)
+            added_bytes = len(compressed)
+
+        self.write_entry({
+            "url": url,
+            "hash": page_hash,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time()
+        })
+
+        # one thread evicts, the others go on
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += added_bytes
+            evict = not self.evicting and (self.total_bytes is None or self.total_bytes > self.max_bytes)
+            if evict:
+                self.evicting = True
+        if evict:
+            try:
+                self.evict()
+            finally:
+                with self.lock:
+                    self.evicting = False
+
+    # the server said that the page did not change (304)
+    def revalidated(self, entry):
+        entry["fetched_at"] = time.time()
+        self.write_entry(entry)
+
+    def write_entry(self, entry):
+        PageCache.write_file(self.url_path(entry["url"]), json.dumps(entry).encode("utf-8"))
+
+    # write to a temporary file, then rename it: readers (and other processes) never see a partial file
+    @staticmethod
+    def write_file(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def list_files(dir_name, suffix):
+        for root, _, file_names in os.walk(dir_name):
+            for file_name in file_names:
+                if file_name.endswith(suffix):
+                    yield os.path.join(root, file_name)
+
+    # all cache entries (for reparse)
+    def entries(self):
+        for path in PageCache.list_files(os.path.join(self.cache_dir, "urls"), ".json"):
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    yield json.load(file)
+            except (OSError, ValueError):
+                continue
+
+    def evict(self):
+        urls = []
+        refs = collections.Counter()
+        for path in PageCache.list_files(os.path.join(self.cache_dir, "urls"), ".json"):
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    entry = json.load(file)
+                urls.append((os.path.getmtime(path), path, entry["hash"]))
+            except (OSError, ValueError, KeyError):
+                continue
+            refs[entry["hash"]] += 1
+
+        page_sizes = {}
+        for path in PageCache.list_files(os.path.join(self.cache_dir, "pages"), ".gz"):
+            page_hash = os.path.basename(path)[:-len(".gz")]
+            if refs[page_hash] == 0:
+                PageCache.remove_file(path)
+            else:
+                page_sizes[page_hash] = os.path.getsize(path)
+
+        total = sum(page_sizes.values())
+        max_total = self.max_bytes if total <= self.max_bytes else PageCache.EVICT_TO * self.max_bytes
+        num_dropped = 0
+        for _, path, page_hash in sorted(urls):
+            if total <= max_total:
+                break
+            PageCache.remove_file(path)
+            num_dropped += 1
+            refs[page_hash] -= 1
+            if refs[page_hash] == 0 and page_hash in page_sizes:
+                PageCache.remove_file(self.page_path(page_hash))
+                total -= page_sizes[page_hash]
+
+        # pages that other processes stored while this one scanned are counted by the next scan
+        with self.lock:
+            self.total_bytes = total
+
+        if self.verbose:
+            print("page cache:", len(urls) - num_dropped, "urls", total, "bytes, dropped:", num_dropped, "urls")
+
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# fetch backend: runs curl for each request (the old way, one process per page)
+class CurlFetcher:
+    def __init__(self, verbose):
+        self.cmd = subb.RunCommand() #trace_on=verbose)
+        self.verbose = verbose
+
+    # returns (http status, page text); status is 0 if the request failed.
+    def fetch(self, url):
+        self.cmd.run("curl " + url)
+        metrics.count("bytes_downloaded", len(self.cmd.output))
+        if self.cmd.exit_code != 0:
+            return 0, self.cmd.output
+        return 200, self.cmd.output
+
+    async def fetch_async(self, url):
+        proc = await asyncio.create_subprocess_exec(
+            "curl", "-s", url, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
         )
-        self.cursor.execute(update_query, item_tuple)
-        self.conn.commit()
+        out, _ = await proc.communicate()
+        metrics.count("bytes_downloaded", len(out))
+        if proc.returncode != 0:
+            return 0, ""
+        return 200, out.decode("utf-8", errors="replace")
+
+
+# fetch backend: in process http client, keeps a pool of keep-alive connections per host.
+# asks for compressed responses, retries failed requests with exponential backoff (except for throttled requests,
+# 429/503: these are returned right away, CrawlerUtil slows down for them). With a PageCache: pages are served from the cache while they are fresh, after that they are revalidated
+# with If-None-Match/If-Modified-Since (if the server sent ETag/Last-Modified).
+class HttpFetcher:
+    RETRY_STATUS = (500, 502, 504)
+
+    def __init__(self, verbose, timeout, retries, backoff=1.0, max_workers=64, cache=None):
+        self.verbose = verbose
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_workers = max_workers
+        self.idle_conns = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get_conn(self, scheme, netloc):
+        with self.lock:
+            if self.idle_conns[(scheme, netloc)]:
+                return self.idle_conns[(scheme, netloc)].pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put_conn(self, scheme, netloc, conn):
+        with self.lock:
+            self.idle_conns[(scheme, netloc)].append(conn)
+
+    @staticmethod
+    def decode_body(resp, body):
+        encoding = resp.getheader("Content-Encoding", "")
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        elif encoding == "deflate":
+            body = zlib.decompress(body)
+        return body.decode("utf-8", errors="replace")
+
+    # returns (http status, page text); status is 0 if the request failed.
+    def fetch(self, url):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = {
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+            "User-Agent": "flagged-hn",
+        }
+
+        cache = self.cache
+        if cache is not None and not PageCache.is_cacheable(parts.path):
+            cache = None
+
+        entry = None
+        if cache is not None:
+            entry = cache.lookup(url)
+            if entry is not None:
+                text = cache.read(entry) if cache.is_fresh(entry) else None
+                if text is not None:
+                    metrics.count("cache_hits")
+                    return 200, text
+                if entry["etag"]:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    headers["If-Modified-Since"] = entry["last_modified"]
+
+        status, text = 0, ""
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                metrics.count("retries")
+                delay = self.backoff * (2 ** (attempt - 1))
+                if self.verbose:
+                    print("retry", attempt, "for url", url, "in", delay, "seconds")
+                time.sleep(delay)
+
+            conn = self.get_conn(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                metrics.count("bytes_downloaded", len(body))
+            except (OSError, http.client.HTTPException) as err:
+                # the server may have closed an idle keep-alive connection, the retry opens a new one
+                conn.close()
+                if self.verbose:
+                    print("request failed: url", url, "error:", err)
+                status, text = 0, ""
+                continue
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self.put_conn(parts.scheme, parts.netloc, conn)
+
+            status, text = resp.status, HttpFetcher.decode_body(resp, body)
+            if status == 304 and entry is not None:
+                cached_text = cache.read(entry)
+                if cached_text is not None:
+                    metrics.count("cache_hits")
+                    cache.revalidated(entry)
+                    return 200, cached_text
+                # the page is gone from the cache, ask again without the conditional headers
+                headers.pop("If-None-Match", None)
+                headers.pop("If-Modified-Since", None)
+                entry = None
+                continue
+            if status == 200 and cache is not None:
+                cache.store(url, text, resp.getheader("ETag"), resp.getheader("Last-Modified"))
+            if status not in HttpFetcher.RETRY_STATUS:
+                break
+
+        if status != 200:
+            print("failed to fetch url", url, "status:", status)
+        return status, text
+
+    async def fetch_async(self, url):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.fetch, url)
+
+
+def make_page_cache(verbose, fetchparams):
+    if not fetchparams.get("cache_dir"):
+        return None
+    return PageCache(verbose, fetchparams["cache_dir"], fetchparams["cache_ttl"], fetchparams["cache_size"] * 1024 * 1024)
+
+
+def make_fetcher(verbose, fetchparams):
+    if fetchparams["backend"] == "curl":
+        if fetchparams.get("cache_dir"):
+            print("the page cache is used with --fetch http only")
+        return CurlFetcher(verbose)
+    return HttpFetcher(verbose, fetchparams["timeout"], fetchparams["retries"], cache=make_page_cache(verbose, fetchparams))
+
+
+# the server kept throttling a fetch for longer than RateController.max_wait (an outage, or a permanent 503).
+# The crawl stops, with its state saved up to the entry before the fetch - it can be resumed later.
+class ThrottledError(Exception):
+    pass
+
+
+# adapts the number of fetches in flight to the answers of the server (AIMD): each successful fetch adds
+# 1/limit to the limit (about one more fetch per round trip of all fetches), a throttled fetch halves it and
+# makes all fetches wait for a backoff delay, that doubles with each throttling in a row (with jitter).
+class RateController:
+    # status codes of a throttled request
+    THROTTLE_STATUS = (429, 503)
+    # the page hn sends instead of the requested page, if there are too many requests
+    THROTTLE_PAGE = "Sorry, we're not able to serve your requests this quickly"
+    # how often to look for a free slot, if all fetches are in flight
+    POLL_INTERVAL = 0.05
+
+    # max_backoff stays well below the lease of a shard worker (default: 300 seconds), the worker sets max_wait
+    # below its lease: a worker that waits for the server doesn't lose its shard.
+    def __init__(self, verbose, backoff=2.0, max_backoff=60.0, max_wait=600.0):
+        self.verbose = verbose
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.max_concurrency = 1
+        self.limit = 1.0
+        self.in_flight = 0
+        self.num_throttled = 0
+        self.total_throttled = 0
+        self.resume_at = 0.0
+
+    # the throttle page is short, a long page that contains the text is a real page (quoting it)
+    @staticmethod
+    def is_throttled(status, text):
+        return status in RateController.THROTTLE_STATUS or (len(text) < 4096 and RateController.THROTTLE_PAGE in text)
+
+    def set_max_concurrency(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+
+    def concurrency(self):
+        return max(1, int(self.limit))
+
+    def on_success(self):
+        self.num_throttled = 0
+        self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+    def on_throttled(self):
+        self.total_throttled += 1
+        metrics.count("throttled")
+        now = time.monotonic()
+        # fetches that were in flight when the server started to throttle are throttled too, count them once
+        if now < self.resume_at:
+            return
+        self.num_throttled += 1
+        self.limit = max(1.0, self.limit / 2)
+        delay = min(self.max_backoff, self.backoff * (2 ** (self.num_throttled - 1)))
+        delay = random.uniform(delay / 2, delay)
+        self.resume_at = now + delay
+        print(f"throttled by server: concurrency {self.concurrency()}, waiting {delay:.1f} seconds")
+
+    def delay(self):
+        return max(0.0, self.resume_at - time.monotonic())
+
+    # a fetch that started at started (time.monotonic) was throttled again: raises ThrottledError if it would wait
+    # for more than max_wait
+    def check_wait(self, url, started):
+        if time.monotonic() + self.delay() - started > self.max_wait:
+            raise ThrottledError(f"throttled by server for more than {self.max_wait:.0f} seconds, url: {url}")
+
+    # wait for the backoff delay and for a free slot
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif self.in_flight < self.concurrency():
+                self.in_flight += 1
+                return
+            else:
+                await asyncio.sleep(RateController.POLL_INTERVAL)
+
+    def release(self):
+        self.in_flight -= 1
 
 
 # tool to help construct web crawlers
 class CrawlerUtil:
-    def __init__(self, verbose):
-        self.cmd = subb.RunCommand() #trace_on=verbose)
+    def __init__(self, verbose, fetchparams):
+        self.fetcher = make_fetcher(verbose, fetchparams)
+        self.rate = RateController(verbose)
         self.verbose = verbose
+        self.text = ""
 
+    # throttled requests are repeated (after the backoff delay), until the server answers (for up to rate.max_wait)
     def fetch_url(self, url):
-        self.cmd.run("curl " + url)
-        return self.cmd.exit_code == 0
+        started = time.monotonic()
+        while True:
+            time.sleep(self.rate.delay())
+            with metrics.timer("fetch"):
+                status, self.text = self.fetcher.fetch(url)
+            if not RateController.is_throttled(status, self.text):
+                break
+            self.rate.on_throttled()
+            self.rate.check_wait(url, started)
+        if status == 200:
+            self.rate.on_success()
+        return status == 200
+
+    # same as fetch_url, but doesn't block the event loop; returns (ok, page text) and leaves the current page alone.
+    # fetches wait for a free slot, there are at most rate.concurrency() fetches in flight.
+    async def fetch_url_async(self, url, limiter=None):
+        started = time.monotonic()
+        while True:
+            await self.rate.acquire()
+            try:
+                if limiter is not None:
+                    await limiter.wait(url)
+                with metrics.timer("fetch"):
+                    status, text = await self.fetcher.fetch_async(url)
+            finally:
+                self.rate.release()
+            if not RateController.is_throttled(status, text):
+                break
+            self.rate.on_throttled()
+            self.rate.check_wait(url, started)
+        if status == 200:
+            self.rate.on_success()
+        return status == 200, text
+
+    # make a page fetched elsewhere the current page (for find_between & co)
+    def set_page(self, text):
+        self.text = text
 
     def page(self):
-        return self.cmd.output
+        return self.text
 
     def find_between(self, from_str, to_str):
-        find_pos = self.cmd.output.find(from_str)
+        find_pos = self.text.find(from_str)
         if find_pos == -1:
             if self.verbose:
                 print("can't find to_str:", to_str)
             return None
-        find_pos_end = self.cmd.output.find(to_str, find_pos + len(from_str))
+        find_pos_end = self.text.find(to_str, find_pos + len(from_str))
         if find_pos_end == -1:
             if self.verbose:
                 print("can't find to_str:", to_str)
             return None
-        return self.cmd.output[find_pos + len(from_str) : find_pos_end]
+        return self.text[find_pos + len(from_str) : find_pos_end]
 
     def find_between_r(self, from_str, to_str):
-        find_pos = self.cmd.output.find(from_str)
+        find_pos = self.text.find(from_str)
         if find_pos == -1:
             if self.verbose:
                 print("can't find from_str:", from_str)
             return None
-        find_pos_end = self.cmd.output.rfind(to_str, 0, find_pos)
+        find_pos_end = self.text.rfind(to_str, 0, find_pos)
         if find_pos_end == -1:
             if self.verbose:
                 print("can't find to_str:", to_str)
             return None
 
-        print("find_pos_end:", find_pos_end, "len:", len(to_str), "find_pos:", find_pos)
-        return self.cmd.output[find_pos_end + len(to_str) : find_pos]
+        if self.verbose:
+            print("find_pos_end:", find_pos_end, "len:", len(to_str), "find_pos:", find_pos)
+        return self.text[find_pos_end + len(to_str) : find_pos]
+
+# spaces out requests to the same host, so that there are at most <rate> requests per second to each host
+class HostRateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = {}
+
+    async def wait(self, url):
+        if self.interval == 0.0:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot.get(host, now))
+        self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
 
 # common hn crawler stuff
 class HNCrawlerUtil:
@@ -186,16 +1440,29 @@ class HNCrawlerUtil:
     TAB_ASK = 2
     TAB_SHOW = 3
 
-    urls = [
-        "https://news.ycombinator.com/newest",
-        "https://news.ycombinator.com/news",
-        "https://news.ycombinator.com/ask",
-        "https://news.ycombinator.com/show",
+    HN_URL = "https://news.ycombinator.com"
+
+    # start of a row of a listing page, and the entry id in it
+    LISTING_ROW = re.compile(r"""<tr class=['"]athing""")
+    LISTING_ROW_ID = re.compile(r"""id=['"](\d+)['"]""")
+
+    # listing page of each tab (under hn_url)
+    TAB_PATHS = [
+        "newest",
+        "news",
+        "ask",
+        "show",
     ]
 
-    def __init__(self, verbose, crawl):
+    # hn_url is where pages are fetched from (can point to a local server, see bench.py). The links
+    # in the stored titles always point to the real site.
+    def __init__(self, verbose, crawl, hn_url=HN_URL):
         self.verbose = verbose
         self.crawl = crawl
+        self.hn_url = hn_url.rstrip("/")
+
+    def tab_url(self, tab):
+        return f"{self.hn_url}/{HNCrawlerUtil.TAB_PATHS[tab]}"
 
     def fetch_entry_ids(self, url):
         self.crawl.fetch_url(url)
@@ -204,153 +1471,722 @@ class HNCrawlerUtil:
             print("items in page: ", url, "items:", ret)
         return ret
 
+    def item_url(self, entry_id):
+        return f"{self.hn_url}/item?id={entry_id}"
+
+    # highest entry id that exists right now (-1 if not found)
+    def find_max_entry_id(self):
+        url = f"{self.hn_url}/newcomments"
+        all_match = self.fetch_entry_ids(url)
+        max_entry = -1
+        for match in all_match:
+            if max_entry < int(match):
+                max_entry = int(match)
+        return max_entry
+
     def fetch_item(self, entry_id):
-        url = "https://news.ycombinator.com/item?id=" + entry_id
+        url = self.item_url(entry_id)
         if self.verbose:
             print("fetch item url:", url)
         self.crawl.fetch_url(url)
+        metrics.count("items_fetched")
+        with metrics.timer("parse"):
+            return self.parse_item(entry_id, url)
+
+    # parse the item page that is the current page of self.crawl
+    def parse_item(self, entry_id, url):
+        fields = HNCrawlerUtil.parse_item_page(self.crawl.page())
+        if fields is None:
+            print("can't find title for url " + url)
+            return None
+
+        if fields["post_time"] is None:
+            print("can't find post time for url " + url)
+        return self.item_rec(entry_id, fields)
+
+    # records of the posts on the listing page (newest, news, ask, show) that is the current page of self.crawl.
+    # Each row of the listing has the same fields as an item page, in the same order.
+    def parse_listing(self):
+        page = self.crawl.page()
+        starts = [match.start() for match in HNCrawlerUtil.LISTING_ROW.finditer(page)]
+        recs = []
+        for num, start in enumerate(starts):
+            end = starts[num + 1] if num + 1 < len(starts) else len(page)
+            match = HNCrawlerUtil.LISTING_ROW_ID.search(page, start, end)
+            fields = HNCrawlerUtil.parse_item_fields(page, start, end)
+            if match is None or fields is None:
+                continue
+            rec = self.item_rec(match.group(1), fields)
+            # jobs have no author and score, the item page doesn't have more
+            rec["complete"] = rec["valid"] and fields["author"] != ""
+            recs.append(rec)
+        return recs
+
+    # post record from the raw fields of an item page (or a row of a listing page)
+    def item_rec(self, entry_id, fields):
+        valid = fields["post_time"] is not None
+
+        title = fields["title"]
+        status = HNCrawlerUtil.STATUS_ACTIVE
+        if title.find("[flagged]") != -1:
+            status = HNCrawlerUtil.STATUS_FLAGGED
+        if title.find("[deleted]") != -1:
+            status = HNCrawlerUtil.STATUS_DELETED
+
+        if self.verbose:
+            print("Raw post fields: valid:", valid, "entry_id:", entry_id, "fields:", fields, "status:", status)
+
+        return {
+            "valid": valid,
+            "entry_id": entry_id,
+            "title": HNCrawlerUtil.clean_title(title, fields["ispost"]),
+            "nscore": int(fields["nscore"]),
+            "ncomments": int(fields["ncomments"]),
+            "author": fields["author"],
+            # newer pages have the unix time after the iso time: title="2021-07-14T09:24:32 1626254672"
+            "created_at": datetime.fromisoformat(fields["post_time"].split(" ")[0]) if valid else None,
+            "status": status,
+            "ispost": fields["ispost"]
+        }
+
+    # the title as shown on the site. Done once at crawl time, instead of each time the site is formatted
+    @staticmethod
+    def clean_title(title, is_post):
+        # for comments: only the link to the story (a header without it is kept as it is)
+        if not is_post:
+            idx = title.find("on:")
+            if idx != -1:
+                title = title[idx:]
+                idx = title.find("</span>")
+                if idx != -1:
+                    title = title[:idx]
+
+        # fix relative links in the title. (hacky hack)
+        title = title.replace('<a href="item?','<a href="https://news.ycombinator.com/item?')
+
+        #dirty hack, to fix hn link to items from the same site.
+        title = title.replace('href="from?site=', 'href="https://news.ycombinator.com/from?site=')
+        return title
+
+    @staticmethod
+    def needs_clean_title(title, is_post):
+        if not is_post and title.find("on:") > 0:
+            return True
+        return title.find('<a href="item?') != -1 or title.find('href="from?site=') != -1
+
+    # extracts the raw fields of an item page in one forward pass over the header of the page (the fatitem table),
+    # the comment tree after it is never looked at.
+    # returns None if there is no title, post_time is None if there is no time.
+    @staticmethod
+    def parse_item_page(page):
+        start = page.find('<table class="fatitem"')
+        if start == -1:
+            start = 0
+            end = len(page)
+        else:
+            # the header can have tables in it (poll options, the comment form): ends at the matching close tag
+            end = HNCrawlerUtil.table_end(page, start)
+        return HNCrawlerUtil.parse_item_fields(page, start, end)
+
+    # end of the table that starts at page[start], after the matching close tag (end of page if there is none)
+    @staticmethod
+    def table_end(page, start):
+        depth = 0
+        pos = start
+        while True:
+            open_pos = page.find("<table", pos)
+            close_pos = page.find("</table>", pos)
+            if close_pos == -1:
+                return len(page)
+            if open_pos != -1 and open_pos < close_pos:
+                depth += 1
+                pos = open_pos + len("<table")
+            else:
+                depth -= 1
+                pos = close_pos + len("</table>")
+                if depth == 0:
+                    return pos
+
+    # the fields of the item in page[start:end]
+    @staticmethod
+    def parse_item_fields(page, start, end):
+        # the title of a post, or the header of a comment (has author and time in it)
+        is_post = True
+        pos = page.find('<td class="title">', start, end)
+        if pos != -1:
+            pos += len('<td class="title">')
+            pos_end = page.find("</td>", pos, end)
+        else:
+            is_post = False
+            pos = page.find('<td class="default">', start, end)
+            if pos == -1:
+                return None
+            pos += len('<td class="default">')
+            pos_end = page.find('<div class="comment">', pos, end)
+        if pos_end == -1:
+            return None
+        title = page[pos:pos_end]
+
+        # the rest comes in this order: score, author, time, comments. pos only moves forward
+        num_score = "0"
+        found = page.find('<span class="score"', pos, end)
+        if found != -1:
+            found_end = page.find("points</span>", found, end)
+            if found_end != -1:
+                score_raw = page[found + len('<span class="score"') : found_end]
+                num_score = score_raw[score_raw.find(">") + 1 :] or "0"
+                pos = found_end
 
-        valid = True
-        title = ""
-        status = 0
-        post_time = ""
         author = ""
-        num_score = ""
-        num_comments = ""
-        is_post = False
+        found = page.find('class="hnuser">', pos, end)
+        if found != -1:
+            found += len('class="hnuser">')
+            found_end = page.find("</a>", found, end)
+            if found_end != -1:
+                author = page[found:found_end]
+                pos = found_end
+
+        post_time = None  # 2021-07-14T09:24:32
+        found = page.find('<span class="age" title="', pos, end)
+        if found != -1:
+            found += len('<span class="age" title="')
+            found_end = page.find('"', found, end)
+            if found_end != -1:
+                post_time = page[found:found_end]
+                pos = found_end
+
+        num_comments = "0"
+        found = page.find("&nbsp;comments</a>", pos, end)
+        if found != -1:
+            found_start = page.rfind('">', pos, found)
+            if found_start != -1:
+                num_comments = page[found_start + 2 : found] or "0"
 
-        try:
-            title = self.crawl.find_between('<td class="title">', "</td>")
+        return {
+            "title": title,
+            "ispost": is_post,
+            "post_time": post_time,
+            "author": author,
+            "nscore": num_score,
+            "ncomments": num_comments
+        }
+
+    # the old extractor (a separate search from the start of the page for each field),
+    # returns the same fields as parse_item_page. Kept to compare results/speed in bench.py
+    def parse_item_page_legacy(self):
+        title = self.crawl.find_between('<td class="title">', "</td>")
+        is_post = True
+        if title is None:
+            is_post = False
+            title = self.crawl.find_between('<td class="default">', '<div class="comment">')
             if title is None:
-                title = self.crawl.find_between('<td class="default">', '<div class="comment">')
-                if title is None:
-                    print("can't find title for url " + url)
-                    return None
-            else:
-                is_post = True
-
-            status = HNCrawlerUtil.STATUS_ACTIVE
-            if title.find("[flagged]") != -1:
-                status = HNCrawlerUtil.STATUS_FLAGGED
-            if title.find("[deleted]") != -1:
-                status = HNCrawlerUtil.STATUS_DELETED
-
-            post_time = self.crawl.find_between(
-                '<span class="age" title="', '"'
-            )  # 2021-07-14T09:24:32
-            if post_time is None:
-                print("can't find post time for url " + url)
-                raise ValueError()
-
-            author = self.crawl.find_between('class="hnuser">', "</a>")
-            if author is None:
-                author = ""
-
-            score_raw = self.crawl.find_between('<span class="score"', "points</span>")
-            if score_raw is None or score_raw == "":
-                num_score = "0"
-            else:
-                pos = score_raw.find(">")
-                num_score = score_raw[pos + 1 :]
+                return None
 
-            num_comments = self.crawl.find_between_r("&nbsp;comments</a>", '">')
-            if num_comments is None or num_comments == "":
-                num_comments = "0"
+        post_time = self.crawl.find_between('<span class="age" title="', '"')
 
-        except ValueError:
-            valid = False
+        author = self.crawl.find_between('class="hnuser">', "</a>")
+        if author is None:
+            author = ""
 
-        if self.verbose:
-            print("Raw post fields: valid:", valid, "entry_id:", entry_id,  "nscore:", num_score, "ncomments:", num_comments, "author:", author, "created_at:", post_time, "status:", status, "ispost:", is_post, "title:", title)
+        score_raw = self.crawl.find_between('<span class="score"', "points</span>")
+        if score_raw is None or score_raw == "":
+            num_score = "0"
+        else:
+            pos = score_raw.find(">")
+            num_score = score_raw[pos + 1 :]
+
+        num_comments = self.crawl.find_between_r("&nbsp;comments</a>", '">')
+        if num_comments is None or num_comments == "":
+            num_comments = "0"
 
         return {
-            "valid": valid,
-            "entry_id": entry_id,
             "title": title,
-            "nscore": int(num_score),
-            "ncomments": int(num_comments),
+            "ispost": is_post,
+            "post_time": post_time,
             "author": author,
-            "created_at": datetime.fromisoformat(post_time),
+            "nscore": num_score,
+            "ncomments": num_comments
+        }
+
+# gets items from the hn api (https://github.com/HackerNews/API) instead of the html item pages.
+# The json for an item is much smaller than the item page (that has the whole comment tree),
+# returns the same records as HNCrawlerUtil
+class HNApiUtil(HNCrawlerUtil):
+    def __init__(self, verbose, crawl, api_url, hn_url=HNCrawlerUtil.HN_URL):
+        super().__init__(verbose, crawl, hn_url)
+        self.api_url = api_url.rstrip("/")
+
+    def item_url(self, entry_id):
+        return f"{self.api_url}/item/{entry_id}.json"
+
+    def find_max_entry_id(self):
+        url = f"{self.api_url}/maxitem.json"
+        if not self.crawl.fetch_url(url):
+            return -1
+        try:
+            return int(json.loads(self.crawl.page()))
+        except (ValueError, TypeError):
+            print("can't parse max item from url " + url)
+            return -1
+
+    # parse the item json that is the current page of self.crawl
+    def parse_item(self, entry_id, url):
+        try:
+            item = json.loads(self.crawl.page())
+        except ValueError:
+            print("can't parse json for url " + url)
+            return None
+        if not isinstance(item, dict) or "time" not in item:
+            # the api returns null for entry ids that don't exist (yet)
+            print("no item for url " + url)
+            return None
+
+        status = HNCrawlerUtil.STATUS_ACTIVE
+        if item.get("dead", False):
+            status = HNCrawlerUtil.STATUS_FLAGGED
+        if item.get("deleted", False):
+            status = HNCrawlerUtil.STATUS_DELETED
+
+        # make the title look like the one on the item page, that's what FormatPage expects.
+        is_post = item.get("type", "") in ("story", "job", "poll")
+        if is_post:
+            if "title" in item:
+                link = html.escape(item.get("url", "item?id=" + entry_id), quote=True)
+                title = f'<span class="titleline"><a href="{link}">{html.escape(item["title"])}</a></span>'
+            elif status == HNCrawlerUtil.STATUS_DELETED:
+                title = "[deleted]"
+            else:
+                title = "[flagged]"
+        else:
+            parent = item.get("parent", "")
+            title = f'<span class="onstory"> | on: <a href="item?id={parent}">parent item {parent}</a></span>'
+
+        rec = {
+            "valid": True,
+            "entry_id": entry_id,
+            "title": HNCrawlerUtil.clean_title(title, is_post),
+            "nscore": int(item.get("score", 0)),
+            "ncomments": int(item.get("descendants", 0)) if is_post else 0,
+            "author": item.get("by", ""),
+            "created_at": datetime.fromtimestamp(item["time"], timezone.utc).replace(tzinfo=None),
             "status": status,
             "ispost": is_post
         }
+        if self.verbose:
+            print("Api post fields:", rec)
+        return rec
+
+
+def make_hncrawl(verbose, crawl, fetchparams):
+    if fetchparams["source"] == "api":
+        return HNApiUtil(verbose, crawl, fetchparams["api_url"], fetchparams["hn_url"])
+    return HNCrawlerUtil(verbose, crawl, fetchparams["hn_url"])
+
+
+# decides when a post is fetched again. Young posts change a lot and are checked often; the interval
+# between checks grows with the age of the post, and doubles each time a check finds no change.
+# Posts older than MAX_AGE are not checked again.
+class RecheckScheduler:
+    MAX_AGE = 10 * 24 * 3600
+
+    # (age of post up to, shortest interval, longest interval), in seconds
+    TIERS = (
+        (6 * 3600, 15 * 60, 3600),
+        (24 * 3600, 3600, 6 * 3600),
+        (3 * 24 * 3600, 3 * 3600, 24 * 3600),
+        (MAX_AGE, 12 * 3600, 3 * 24 * 3600),
+    )
+
+    # first retry after a check that failed, (about) doubles with each failure that follows
+    RETRY_INTERVAL = 15 * 60
+    MAX_RETRY_INTERVAL = 3 * 24 * 3600
+
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    # times from hn are utc without time zone, times from the db have a time zone
+    @staticmethod
+    def epoch_seconds(time_value):
+        if time_value.tzinfo is None:
+            time_value = time_value.replace(tzinfo=timezone.utc)
+        return time_value.timestamp()
+
+    # should the post be fetched? rec is the db record, None for posts that are not in the db yet
+    def is_due(self, rec, now):
+        if rec is None:
+            return True
+        if self.verbose:
+            print("existing post:", rec)
+        if rec["next_check_at"] is None:
+            if rec["last_checked_at"] is not None:
+                # too old, no more checks
+                return False
+            # crawled before there was a schedule: recheck if not older than MAX_AGE
+            return now - RecheckScheduler.epoch_seconds(rec["created_at"]) < RecheckScheduler.MAX_AGE
+        return RecheckScheduler.epoch_seconds(rec["next_check_at"]) <= now
+
+    # sets last_checked_at and next_check_at of the fetched record check_rec.
+    # returns True if the post is new, or if its status/score/comments changed since rec was fetched.
+    def schedule(self, rec, check_rec, now):
+        changed = True
+        if rec is not None:
+            if check_rec["status"] != rec["status"] and self.verbose:
+                print("status of ", rec["entry_id"], "changed from: ", rec["status"], "to:", check_rec["status"])
+            changed = (
+                check_rec["status"] != rec["status"]
+                or check_rec["nscore"] != rec["nscore"]
+                or check_rec["ncomments"] != rec["ncomments"]
+            )
+
+        age = now - RecheckScheduler.epoch_seconds(check_rec["created_at"])
+        interval = None
+        for max_age, min_interval, max_interval in RecheckScheduler.TIERS:
+            if age < max_age:
+                interval = min_interval
+                if not changed and rec["next_check_at"] is not None and rec["last_checked_at"] is not None:
+                    last_interval = RecheckScheduler.epoch_seconds(rec["next_check_at"]) - RecheckScheduler.epoch_seconds(rec["last_checked_at"])
+                    interval = min(max(2 * last_interval, min_interval), max_interval)
+                break
+
+        check_rec["last_checked_at"] = datetime.fromtimestamp(now, timezone.utc)
+        check_rec["next_check_at"] = None
+        if interval is not None:
+            check_rec["next_check_at"] = datetime.fromtimestamp(now + interval, timezone.utc)
+        return changed
+
+    # the check of the db record rec failed (fetch error, page that can't be parsed): returns a copy of rec that is
+    # due again later, so that it doesn't stay at the head of the due posts. No more checks once it is too old.
+    def postpone(self, rec, now):
+        post_rec = dict(rec)
+        if rec["created_at"] is None or now - RecheckScheduler.epoch_seconds(rec["created_at"]) >= RecheckScheduler.MAX_AGE:
+            post_rec["last_checked_at"] = datetime.fromtimestamp(now, timezone.utc)
+            post_rec["next_check_at"] = None
+            return post_rec
+
+        # last_checked_at stays the time of the last check that worked, the retry interval grows with the time since then
+        interval = RecheckScheduler.RETRY_INTERVAL
+        if rec["next_check_at"] is not None and rec["last_checked_at"] is not None:
+            last_interval = RecheckScheduler.epoch_seconds(rec["next_check_at"]) - RecheckScheduler.epoch_seconds(rec["last_checked_at"])
+            interval = min(max(2 * last_interval, RecheckScheduler.RETRY_INTERVAL), RecheckScheduler.MAX_RETRY_INTERVAL)
+        post_rec["next_check_at"] = datetime.fromtimestamp(now + interval, timezone.utc)
+        return post_rec
+
 
 class HHCrawlerOnEntryIdRange:
-    def __init__(self, verbose, entry_id_from, entry_id_to, dbparams):
+    # number of entry ids that are looked up in the db with one query
+    DB_WINDOW = 1000
+
+    # name of the checkpoint in the crawl_state table
+    STATE_NAME = "crawl"
+
+    # returned instead of a record, for an item that was classified as not worth fetching
+    SKIPPED = {"valid": False}
+
+    def __init__(self, verbose, entry_id_from, entry_id_to, dbparams, fetchparams, resume=False, classify=False):
         self.entry_id_from = entry_id_from
         self.entry_id_to = entry_id_to
         self.verbose = verbose
-        self.dblayer = DBLayer(verbose, dbparams)
+        self.resume = resume
+        self.dblayer = make_dblayer(verbose, dbparams)
+        self.writer = PostWriter(self.dblayer)
 
-        crawl = CrawlerUtil(verbose)
+        # ranges of entry ids (from, to) that were crawled completely, and where this run started
+        self.done_ranges = []
+        self.run_from = entry_id_from
+        # set to stop crawl_range early
+        self.stopped = False
 
-        self.crawl = crawl
-        self.hncrawl = HNCrawlerUtil(verbose, crawl)
-        self.epoch_seconds_now = int(datetime.now().strftime("%s"))
+        crawl = CrawlerUtil(verbose, fetchparams)
 
+        self.crawl = crawl
+        self.hncrawl = make_hncrawl(verbose, crawl, fetchparams)
+        self.scheduler = RecheckScheduler(verbose)
+
+        # with classify: the api item (a few hundred bytes) is fetched first, the item page only if needed
+        self.classifier = None
+        if classify and fetchparams["source"] != "api":
+            self.classifier = HNApiUtil(verbose, crawl, fetchparams["api_url"], fetchparams["hn_url"])
+
+
+    def scan(self, concurrency=1, rate=0):
+        self.start_scan()
+        self.crawl_range(concurrency, rate)
+
+    # crawl from entry_id_from down to entry_id_to. With concurrency > 1: keeps up to <concurrency> item fetches
+    # in flight, but results are still written in order of descending entry ids, so that entry_id_from is always
+    # the highest entry id that has not been written yet.
+    def crawl_range(self, concurrency, rate):
+        self.stopped = False
+        with self.writer:
+            if concurrency > 1:
+                asyncio.run(self.fetch_pipeline(self.range_entries(), concurrency, HostRateLimiter(rate), self.set_watermark))
+            else:
+                for entry_id, rec in self.range_entries():
+                    if self.scheduler.is_due(rec, time.time()):
+                        self.store_item(rec, self.fetch_item(str(entry_id), rec))
+                    else:
+                        metrics.count("skipped")
+                    self.set_watermark(entry_id)
+            if not self.stopped:
+                self.entry_id_from = min(self.entry_id_from, self.entry_id_to)
+
+    # sets the range to crawl: continues an unfinished crawl with --resume, unless a range is given (--from/--to).
+    # The state of the crawl is saved whenever posts are written (and at least every max_seconds of the writer)
+    def start_scan(self):
+        state = self.dblayer.load_crawl_state(HHCrawlerOnEntryIdRange.STATE_NAME)
+        if state is not None:
+            self.done_ranges = state["done_ranges"]
+
+        unfinished = self.resume and state is not None and not state["finished"]
+        if unfinished and self.entry_id_from == -1 and self.entry_id_to == 0:
+            print("resume crawl at entry id:", state["watermark"], "to:", state["entry_id_to"])
+            self.entry_id_from = state["watermark"]
+            self.entry_id_to = state["entry_id_to"]
+        else:
+            if self.entry_id_from == -1:
+                self.entry_id_from = self.find_highest_entry_id()
+            if unfinished:
+                print("crawl the given range from entry id:", self.entry_id_from, "to:", self.entry_id_to,
+                      "- the unfinished crawl at entry id:", state["watermark"], "to:", state["entry_id_to"], "is not resumed (ranges that were crawled completely are still skipped)")
+
+        self.run_from = self.entry_id_from
+        self.writer.on_flush = self.save_state
+
+    def save_state(self):
+        # entry ids from entry_id_from (not included) up to run_from are done.
+        self.done_ranges = HHCrawlerOnEntryIdRange.merge_ranges(self.done_ranges + [[self.run_from, self.entry_id_from]])
+        self.dblayer.save_crawl_state(HHCrawlerOnEntryIdRange.STATE_NAME, {
+            "watermark": self.entry_id_from,
+            "entry_id_to": self.entry_id_to,
+            "finished": self.entry_id_from <= self.entry_id_to,
+            "done_ranges": self.done_ranges
+        })
+
+    # merge (from, to) ranges (meaning from >= entry id > to) that overlap or touch. Sorted by from, descending
+    @staticmethod
+    def merge_ranges(ranges):
+        merged = []
+        for range_from, range_to in sorted((r for r in ranges if r[0] > r[1]), reverse=True):
+            if merged and range_from >= merged[-1][1]:
+                merged[-1][1] = min(merged[-1][1], range_to)
+            else:
+                merged.append([range_from, range_to])
+        return merged
+
+    # fetch the posts that are due for a recheck (at most limit posts, 0 - all of them)
+    def recheck(self, limit, concurrency, rate):
+        with self.writer:
+            if concurrency > 1:
+                asyncio.run(self.fetch_pipeline(self.due_entries(limit), concurrency, HostRateLimiter(rate), None))
+            else:
+                for entry_id, rec in self.due_entries(limit):
+                    self.store_item(rec, self.fetch_item(str(entry_id), rec))
+
+    # rebuild the posts from the item pages in the page cache, without fetching anything. Handles item pages
+    # and api items (whatever --source they were fetched with); the post is scheduled for a recheck
+    # as if it was checked at the time the page was fetched.
+    def reparse(self, cache):
+        parsers = (
+            (re.compile(r"item\?id=(\d+)$"), HNCrawlerUtil(self.verbose, self.crawl)),
+            (re.compile(r"/item/(\d+)\.json$"), HNApiUtil(self.verbose, self.crawl, "")),
+        )
+        num_posts = 0
+        recs = []
+        with self.writer:
+            for entry in cache.entries():
+                for pattern, parser in parsers:
+                    match = pattern.search(entry["url"])
+                    if match is not None:
+                        break
+                else:
+                    continue
 
-    def scan(self):
-        if self.entry_id_from == -1:
-            self.entry_id_from = self.find_highest_entry_id()
+                text = cache.read(entry)
+                if text is None:
+                    continue
+                self.crawl.set_page(text)
+                rec = parser.parse_item(match.group(1), entry["url"])
+                if rec is None or not rec["valid"]:
+                    continue
 
-        while self.entry_id_from > self.entry_id_to:
+                self.scheduler.schedule(None, rec, entry["fetched_at"])
+                recs.append(rec)
+                if len(recs) == HHCrawlerOnEntryIdRange.DB_WINDOW:
+                    num_posts += self.reparse_store(recs)
+                    recs = []
+            num_posts += self.reparse_store(recs)
 
-            entry_id = str(self.entry_id_from)
-            self.entry_id_from -= 1
+        print("posts rebuilt from the page cache:", num_posts)
 
-            rec = self.dblayer.find_post(entry_id)
-            if rec is None:
-                # new post
-                rec = self.hncrawl.fetch_item(entry_id)
-                if rec is None:
-                    continue
-                if rec["valid"]:
-                    if self.verbose:
-                        print("post scanned: ", rec)
-                    self.dblayer.insert_post(rec, 0)
+    # posts that are in the db already keep their tab (set by oldcrawl)
+    def reparse_store(self, recs):
+        if not recs:
+            return 0
+        db_recs = self.dblayer.find_posts([rec["entry_id"] for rec in recs])
+        for rec in recs:
+            db_rec = db_recs.get(int(rec["entry_id"]))
+            self.writer.add(rec, 0 if db_rec is None else db_rec["tab"])
+        self.writer.flush_if_due()
+        return len(recs)
+
+    def set_watermark(self, entry_id):
+        self.entry_id_from = entry_id - 1
+        self.writer.flush_if_due()
+
+    # yields (entry_id, db record or None) from entry_id_from down to entry_id_to (not included).
+    # the db records are read for DB_WINDOW entry ids at a time. With --resume, ranges that were done
+    # by earlier crawls are skipped.
+    def range_entries(self):
+        skip_ranges = self.done_ranges if self.resume else []
+        entry_id = self.entry_id_from
+        while entry_id > self.entry_id_to:
+            window_to = max(self.entry_id_to, entry_id - HHCrawlerOnEntryIdRange.DB_WINDOW)
+            for range_from, range_to in skip_ranges:
+                if range_to < entry_id <= range_from:
+                    entry_id = range_to
+                elif range_from < entry_id:
+                    window_to = max(window_to, range_from)
+            if entry_id <= window_to:
+                continue
+
+            existing = self.dblayer.find_posts_range(entry_id, window_to)
+            while entry_id > window_to:
+                if self.stopped:
+                    return
+                yield entry_id, existing.get(entry_id)
+                entry_id -= 1
+
+    # yields (entry_id, db record) of posts that are due for a recheck, each post at most once
+    def due_entries(self, limit):
+        seen = set()
+        while True:
+            # posts that were checked already must be in the db, so that they are no longer due
+            self.writer.flush()
+            due = [rec for rec in self.dblayer.find_due_posts(HHCrawlerOnEntryIdRange.DB_WINDOW) if rec["entry_id"] not in seen]
+            if not due:
+                return
+            for rec in due:
+                if 0 < limit <= len(seen):
+                    return
+                seen.add(rec["entry_id"])
+                yield rec["entry_id"], rec
+
+    # keeps up to <concurrency> item fetches in flight, for the (entry_id, db record) pairs of entries.
+    # results are written in the order of entries; on_done(entry_id) is called after an entry is done.
+    async def fetch_pipeline(self, entries, concurrency, limiter, on_done):
+        # entries of (entry_id, db record, fetch task or None)
+        pending = collections.deque()
+        num_fetches = 0
+        entries = iter(entries)
+        more_entries = True
+        # the number of fetches in flight goes down when the server throttles, and slowly back up to concurrency
+        self.crawl.rate.set_max_concurrency(concurrency)
+
+        while pending or more_entries:
+
+            # fill up the pipeline. don't look too far ahead if most entries don't need a fetch
+            while more_entries and num_fetches < self.crawl.rate.concurrency() and len(pending) < 4 * concurrency:
+                entry = next(entries, None)
+                if entry is None:
+                    more_entries = False
+                    break
+
+                entry_id, rec = entry
+                task = None
+                if self.scheduler.is_due(rec, time.time()):
+                    task = asyncio.create_task(self.fetch_item_async(str(entry_id), rec, limiter))
+                    num_fetches += 1
+                pending.append((entry_id, rec, task))
+
+            if not pending:
+                break
+
+            entry_id, rec, task = pending.popleft()
+            if task is not None:
+                check_rec = await task
+                num_fetches -= 1
+                self.store_item(rec, check_rec)
             else:
-                if self.verbose:
-                    print("existing post:", rec)
-                # created_at = datetime.fromisoformat(rec['created_at'])
-
-                epoch_seconds_post = int(rec["created_at"].strftime("%s"))
-                if (self.epoch_seconds_now - epoch_seconds_post) < (10 * 24 * 3600):
-                    # re check posts not older than ten days
-                    check_rec = self.hncrawl.fetch_item(entry_id)
-                    if check_rec is None:
-                        continue
-                    if check_rec["valid"]:
-                        status_changed = False
-                        if check_rec["status"] != rec["status"]:
-                            if self.verbose:
-                                print(
-                                    "status of ",
-                                    rec["entry_id"],
-                                    "changed from: ",
-                                    rec["status"],
-                                    "to:",
-                                    check_rec["status"],
-                                )
-                                status_changed = True
-                        if (
-                            status_changed
-                            or rec["nscore"] != check_rec["nscore"]
-                            or rec["ncomments"] != check_rec["ncomments"]
-                        ):
-                            self.dblayer.update_post(check_rec, 0)
-
-
+                metrics.count("skipped")
+            if on_done is not None:
+                on_done(entry_id)
+
+    def fetch_item(self, entry_id, rec):
+        if self.classifier is not None:
+            item = self.classifier.fetch_item(entry_id)
+            if not self.needs_item_page(item, rec):
+                return self.classified_item(item, rec)
+        return self.hncrawl.fetch_item(entry_id)
+
+    async def fetch_item_async(self, entry_id, rec, limiter):
+        if self.classifier is not None:
+            item = await self.fetch_parse_async(self.classifier, entry_id, limiter)
+            if not self.needs_item_page(item, rec):
+                return self.classified_item(item, rec)
+        return await self.fetch_parse_async(self.hncrawl, entry_id, limiter)
+
+    # classify: most items are active comments, only posts and flagged/deleted items (or ones that were
+    # flagged/deleted before) get the item page.
+    def needs_item_page(self, item, rec):
+        if item is None or not item["valid"]:
+            return False
+        return item["ispost"] or item["status"] != HNCrawlerUtil.STATUS_ACTIVE or (rec is not None and rec["status"] != HNCrawlerUtil.STATUS_ACTIVE)
+
+    # record of an item that doesn't get the item page: an active comment that is not in the db is stored from the
+    # api item while it is younger than RecheckScheduler.MAX_AGE (it may still be flagged, the recheck finds out),
+    # an older one is skipped: it is not checked again. One that is in the db already is updated by the api item,
+    # but the title from the item page stays.
+    def classified_item(self, item, rec):
+        if item is None or not item["valid"]:
+            return item
+        if rec is None:
+            if item["created_at"] is None or time.time() - RecheckScheduler.epoch_seconds(item["created_at"]) >= RecheckScheduler.MAX_AGE:
+                metrics.count("classified_skipped")
+                return HHCrawlerOnEntryIdRange.SKIPPED
+            return item
+        item["title"] = rec["title"]
+        return item
+
+    async def fetch_parse_async(self, hncrawl, entry_id, limiter):
+        url = hncrawl.item_url(entry_id)
+        if self.verbose:
+            print("fetch item url:", url)
+        # a throttled fetch is repeated, the entry is not skipped (ThrottledError stops the crawl before it)
+        ok, text = await self.crawl.fetch_url_async(url, limiter)
+        metrics.count("items_fetched")
+        if not ok:
+            print("failed to fetch url " + url)
+            return None
+        # parsing happens right here, there is no await between set_page and parse_item
+        self.crawl.set_page(text)
+        with metrics.timer("parse"):
+            return hncrawl.parse_item(entry_id, url)
+
+    # write the result of fetching an entry; rec is the existing db record (or None for a new post)
+    def store_item(self, rec, check_rec):
+        metrics.report_if_due()
+        if check_rec is HHCrawlerOnEntryIdRange.SKIPPED:
+            return
+        if check_rec is None or not check_rec["valid"]:
+            metrics.count("fetch_failed")
+            if rec is not None:
+                self.writer.add(self.scheduler.postpone(rec, time.time()), rec["tab"])
+            return
+
+        changed = self.scheduler.schedule(rec, check_rec, time.time())
+        if rec is None and self.verbose:
+            print("post scanned: ", check_rec)
+        Metrics.count_checked(rec, changed)
+
+        # written even if nothing changed, the time of the next check did.
+        self.writer.add(check_rec, 0)
+        self.writer.add_event(rec, check_rec)
 
     def find_highest_entry_id(self):
-        url = "https://news.ycombinator.com/newcomments"
-        all_match = self.hncrawl.fetch_entry_ids(url)
-        max_entry = -1
-        for match in all_match:
-            if max_entry < int(match):
-                max_entry = int(match)
+        max_entry = self.hncrawl.find_max_entry_id()
 
         if self.verbose:
-            print("Highest entry_id: ", self.entry_id_from)
+            print("Highest entry_id: ", max_entry)
 
         if max_entry == -1:
             print("Error: can't find highest entry id")
@@ -358,28 +2194,173 @@ class HHCrawlerOnEntryIdRange:
 
         return max_entry
 
+# crawls an entry id range that is split into shards (table crawl_shards). Any number of workers,
+# on one or on several machines, claim a shard, crawl it and mark it as done. A claimed shard has a lease
+# that is extended while the worker makes progress; once the lease expires (the worker died) the shard
+# is picked up by another worker, at the watermark that was saved last.
+class HNShardWorker:
+    def __init__(self, verbose, dbparams, fetchparams, lease_seconds, concurrency, rate):
+        self.verbose = verbose
+        self.lease_seconds = lease_seconds
+        self.concurrency = concurrency
+        self.rate = rate
+        self.worker_name = f"{socket.gethostname()}:{os.getpid()}"
+        self.crawler = HHCrawlerOnEntryIdRange(verbose, -1, 0, dbparams, fetchparams)
+        self.dblayer = self.crawler.dblayer
+        self.shard_from = None
+        # the lease is extended when posts are written: don't wait for the server for longer than that
+        rate_controller = self.crawler.crawl.rate
+        rate_controller.max_wait = min(rate_controller.max_wait, lease_seconds / 2)
+        rate_controller.max_backoff = min(rate_controller.max_backoff, lease_seconds / 4)
+
+    def run(self):
+        num_shards = 0
+        while True:
+            shard = self.dblayer.claim_shard(self.worker_name, self.lease_seconds)
+            if shard is None:
+                print("no more shards to crawl, shards crawled by this worker:", num_shards)
+                return
+
+            self.shard_from, shard_to, watermark = shard
+            print("worker:", self.worker_name, "crawl shard:", self.shard_from, "to:", shard_to, "from entry id:", watermark)
+
+            self.crawler.entry_id_from = watermark
+            self.crawler.entry_id_to = shard_to
+            self.crawler.writer.on_flush = self.save_state
+            self.crawler.crawl_range(self.concurrency, self.rate)
+
+            if self.crawler.stopped:
+                print("lost the lease on shard:", self.shard_from)
+            else:
+                self.dblayer.complete_shard(self.shard_from, self.worker_name)
+                num_shards += 1
+
+    # saves the watermark of the shard and extends the lease (called by the writer before it commits)
+    def save_state(self):
+        if not self.dblayer.update_shard(self.shard_from, self.worker_name, self.crawler.entry_id_from, self.lease_seconds):
+            # another worker has the shard now
+            self.crawler.stopped = True
+
+    # split the range from entry_id_from down to entry_id_to into shards of shard_size entry ids
+    @staticmethod
+    def make_shards(dblayer, entry_id_from, entry_id_to, shard_size):
+        shards = []
+        shard_from = entry_id_from
+        while shard_from > entry_id_to:
+            shard_to = max(entry_id_to, shard_from - shard_size)
+            shards.append((shard_from, shard_to))
+            shard_from = shard_to
+        dblayer.create_shards(shards)
+        print("shards created:", len(shards))
+
+
+# follows new posts as they come in: polls the highest entry id every interval seconds, fetches the entry ids
+# that are new since the last poll, then the posts that are due for a recheck. Runs until it is stopped,
+# with the same db connection and http connections all the time.
+class HNTailCrawler:
+    STATE_NAME = "tail"
+
+    def __init__(self, verbose, dbparams, fetchparams, interval, recheck_limit, concurrency, rate):
+        self.verbose = verbose
+        self.interval = interval
+        self.recheck_limit = recheck_limit
+        self.concurrency = concurrency
+        self.rate = rate
+        self.crawler = HHCrawlerOnEntryIdRange(verbose, -1, 0, dbparams, fetchparams)
+        self.dblayer = self.crawler.dblayer
+
+    def run(self):
+        # the highest entry id that was crawled (by an earlier run), otherwise start at the current frontier
+        last_max = None
+        state = self.dblayer.load_crawl_state(HNTailCrawler.STATE_NAME)
+        if state is not None:
+            last_max = state["last_max"]
+            print("tail: continue after entry id:", last_max)
+
+        while True:
+            start = time.monotonic()
+            # the connection was idle while sleeping, the db may have been restarted
+            self.dblayer.check_connection()
+
+            max_entry = self.crawler.hncrawl.find_max_entry_id()
+            if max_entry == -1:
+                print("tail: can't find highest entry id")
+            else:
+                if last_max is None:
+                    last_max = max_entry - 1
+                if max_entry > last_max:
+                    if self.verbose:
+                        print("tail: new entry ids:", max_entry, "down to", last_max + 1)
+                    self.crawler.entry_id_from = max_entry
+                    self.crawler.entry_id_to = last_max
+                    self.crawler.crawl_range(self.concurrency, self.rate)
+
+                    last_max = max_entry
+                    self.save_state(last_max)
+
+            self.crawler.recheck(self.recheck_limit, self.concurrency, self.rate)
+
+            elapsed = time.monotonic() - start
+            if self.verbose:
+                print(f"tail: poll done in {elapsed:.1f} seconds, highest entry id: {last_max}")
+            if elapsed < self.interval:
+                time.sleep(self.interval - elapsed)
+
+    def save_state(self, last_max):
+        def save():
+            self.dblayer.save_crawl_state(HNTailCrawler.STATE_NAME, { "last_max": last_max })
+            self.dblayer.commit()
+        self.dblayer.with_reconnect(save)
+
+
 class HNCrawlerFollowNextPage:
-    def __init__(self, verbose, dbparams):
+    def __init__(self, verbose, dbparams, fetchparams, resume=False):
 
-        self.dblayer = DBLayer(verbose, dbparams)
-        crawl = CrawlerUtil(verbose)
+        self.resume = resume
+        self.state_name = None
+        # the page to crawl next (with the next_id/next_n arguments for the newest tab)
+        self.cursor = None
+        self.dblayer = make_dblayer(verbose, dbparams)
+        self.writer = PostWriter(self.dblayer)
+        crawl = CrawlerUtil(verbose, fetchparams)
 
         self.verbose = verbose
         self.crawl = crawl
-        self.hncrawl = HNCrawlerUtil(verbose, crawl)
-        self.epoch_seconds_now = int(datetime.now().strftime("%s"))
+        self.hncrawl = make_hncrawl(verbose, crawl, fetchparams)
+        self.scheduler = RecheckScheduler(verbose)
 
     def scan(self, pages, tab):
 
         print("starting the crawl: 'Forwaerts immer, rueckwaerts nimmer!'/'forward ever backward never' Erich Honecker ... max-page: ", pages)
 
+        # the state is saved whenever posts are written, with --resume the crawl continues at the saved page.
+        self.state_name = f"oldcrawl_{tab}"
+        self.cursor = { "page": 1, "next_id": None, "next_n": None, "finished": False }
+        if self.resume:
+            state = self.dblayer.load_crawl_state(self.state_name)
+            if state is not None and not state["finished"]:
+                print("resume crawl at page:", state["page"])
+                self.cursor = state
+        self.writer.on_flush = self.save_state
+
+        with self.writer:
+            last_page = self.scan_impl(pages, tab)
+            self.cursor["finished"] = True
+        return last_page
+
+    def save_state(self):
+        self.dblayer.save_crawl_state(self.state_name, self.cursor)
+
+    def scan_impl(self, pages, tab):
         insert_or_up = 0
+        next_id = self.cursor["next_id"]
+        next_n = self.cursor["next_n"]
 
-        for page in range(1, pages):
+        for page in range(self.cursor["page"], pages):
 
             print("scanning page:", page)
 
-            url = HNCrawlerUtil.urls[tab]
+            url = self.hncrawl.tab_url(tab)
 
             if tab == HNCrawlerUtil.TAB_NEWEST:
                 if page > 1:
@@ -389,6 +2370,7 @@ class HNCrawlerFollowNextPage:
                     url += "?p=" + str(page)
 
             all_match = self.hncrawl.fetch_entry_ids(url)
+            listing = { rec["entry_id"] : rec for rec in self.hncrawl.parse_listing() }
 
             if tab == HNCrawlerUtil.TAB_NEWEST:
                 match = re.search(
@@ -407,7 +2389,7 @@ class HNCrawlerFollowNextPage:
             if self.verbose:
                 print("page:",url, "posts:", all_match)
 
-            insert_or_update = self.process_items(all_match, tab)
+            insert_or_update = self.process_items(all_match, tab, listing)
             if insert_or_update == 0:
                 insert_or_up += 1
 #                if insert_or_up == 2:
@@ -415,60 +2397,54 @@ class HNCrawlerFollowNextPage:
             else:
                 insert_or_up = 0
 
+            self.cursor = { "page": page + 1, "next_id": next_id, "next_n": next_n, "finished": False }
+            self.writer.flush_if_due()
+
         return pages
 
-    def process_items(self, all_match, tab):
+    # listing: records from the listing page, by entry id. The item page is fetched only for posts that
+    # are not on the listing, that miss a field, or that are not active (to see if they are flagged or deleted)
+    def process_items(self, all_match, tab, listing):
         insert_or_update = 0
 
+        # get all posts of the page that are already in the db with one query
+        existing = self.dblayer.find_posts(all_match)
+
         for entry_id in all_match:
 
-            rec = self.dblayer.find_post(entry_id)
-            if rec is None:
-                # new post
-                rec = self.hncrawl.fetch_item(entry_id)
-                if rec is None:
-                    continue
+            metrics.report_if_due()
+            rec = existing.get(int(entry_id))
+            if not self.scheduler.is_due(rec, time.time()):
+                metrics.count("skipped")
+                continue
 
-                if rec["valid"]:
-                    if self.verbose:
-                        print("post scanned: ", rec)
-                    self.dblayer.insert_post(rec, tab)
-                    insert_or_update += 1
+            check_rec = listing.get(entry_id)
+            if (check_rec is not None and check_rec["complete"] and check_rec["status"] == HNCrawlerUtil.STATUS_ACTIVE
+                    and (rec is None or rec["status"] == HNCrawlerUtil.STATUS_ACTIVE)):
+                metrics.count("from_listing")
             else:
-                if self.verbose:
-                    print("existing post:", rec)
-                # created_at = datetime.fromisoformat(rec['created_at'])
-
-                epoch_seconds_post = int(rec["created_at"].strftime("%s"))
-                if (self.epoch_seconds_now - epoch_seconds_post) < (10 * 24 * 3600):
-                    # re check posts not older than ten days
-                    check_rec = self.hncrawl.fetch_item(entry_id)
-                    if check_rec is None:
-                        continue
-                    if check_rec["valid"]:
-                        status_changed = False
-                        if check_rec["status"] != rec["status"]:
-                            if self.verbose:
-                                print(
-                                    "status of ",
-                                    rec["entry_id"],
-                                    "changed from: ",
-                                    rec["status"],
-                                    "to:",
-                                    check_rec["status"],
-                                )
-                                status_changed = True
-                        if (
-                            status_changed
-                            or rec["nscore"] != check_rec["nscore"]
-                            or rec["ncomments"] != check_rec["ncomments"]
-                        ):
-                            self.dblayer.update_post(check_rec, tab)
-                            insert_or_update += 1
+                check_rec = self.hncrawl.fetch_item(entry_id)
+            if check_rec is None or not check_rec["valid"]:
+                metrics.count("fetch_failed")
+                continue
+
+            changed = self.scheduler.schedule(rec, check_rec, time.time())
+            Metrics.count_checked(rec, changed)
+            if changed:
+                if rec is None and self.verbose:
+                    print("post scanned: ", check_rec)
+                insert_or_update += 1
+            self.writer.add(check_rec, tab)
+            self.writer.add_event(rec, check_rec)
         return insert_or_update
 
 
-class FormatPage:
+# renders the html of a page. Doesn't touch the db, so that pages can be rendered in worker processes
+class PageRenderer:
+
+    # part of the hash of each page (FormatPage.write_page): increment when show_item changes, so that
+    # format --incremental writes all pages again
+    VERSION = 1
 
     title = (
             'link to flagged comments',
@@ -480,57 +2456,60 @@ class FormatPage:
             "page_1.html",
            )
 
-    def __init__(self, verbose, dbparams):
-        self.verbose = verbose
-        self.dblayer = DBLayer(verbose, dbparams)
-        self.page_file = None
-        self.prefix = None
-        self.title_idx = 0
-
-
-    def format(self):
-        print("'Nobody has any intention of building a wall' Walter Ulbricht")
-
-        self.title_idx = 0
-        self.prefix = "page_"
-        self.format_one(True)
-
-        self.title_idx = 1
-        self.prefix = "comments_"
-        self.format_one(False)
-
-
-    def format_one(self, show_articles):
+    # the footer without the link to the next page
+    FOOTER_START = """
+          <tr class="spacer" style="height:5px"></tr>
+          <tr class="morespace" style="height:10px"></tr>
+          <tr>
+            <td colspan="2"></td>
+            <td class="title">
+              <a
+                href="""
 
-        print("format:", show_articles)
+    FOOTER_END = """
+                class="morelink"
+                >More</a
+              >
+            </td>
+          </tr>
+      </table>
+   </td>
+</tr>
+</table>
 
-        rows = self.dblayer.find_non_active(show_articles)
+"""
 
-        item = 0
-        page_count = 1
+    # header for each title_idx, made once per process
+    headers = {}
 
-        for row in rows:
-            if item == 0:
-                self.show_page_header(page_count)
-                page_count += 1
-                item = 1
+    def __init__(self, verbose, prefix, title_idx):
+        self.verbose = verbose
+        self.prefix = prefix
+        self.title_idx = title_idx
+        self.header = PageRenderer.page_header(title_idx)
 
-            item += self.show_item(item, row, show_articles)
+    # page_items: list of (row, title as shown). Returns the whole page as one string
+    def render_page(self, page_number, page_items):
+        if self.verbose:
+            print(f"show page header {page_number}")
 
-            if item == 31:
-                self.show_page_footer(page_count-1)
-                item = 0
+        parts = [self.header]
+        for item_num, (row, title) in enumerate(page_items, 1):
+            parts.append(self.show_item(item_num, row, title))
 
-        if item != 0:
-            self.show_page_footer(page_count-1)
+        if self.verbose:
+            print(f"show page footer next-page: {page_number}")
+        parts.append(PageRenderer.FOOTER_START)
+        parts.append(f'"{self.prefix}{page_number+1}.html"')
+        parts.append(PageRenderer.FOOTER_END)
 
+        return "".join(parts)
 
-    def show_item(self, item_num, row, show_articles):
+    def show_item(self, item_num, row, title):
         if self.verbose:
             print("item:", item_num, "row:", row)
 
         entry_id = row[0]
-        title = row[2]
         nscore = int(row[3])
         ncomments = int(row[4])
         author = row[5]
@@ -538,25 +2517,7 @@ class FormatPage:
         time_str = created_at.strftime("%d/%m/%y")
         time_str_hint = created_at.strftime("%Y-%m-%d%z%H:%M:%S")
 
-        # too lazy to fix up the crawler, instead fudge with the title...
-        if not show_articles:
-            idx = title.find("on:")
-            title = title[idx:]
-            idx = title.find("</span>")
-            title = title[:idx]
-
-        # fix relative links in the title. (hacky hack)
-        title = title.replace('<a href="item?','<a href="https://news.ycombinator.com/item?')
-
-        if title == "[flagged]":
-            if self.verbose:
-                print("item {entry_id} flagged into oblivion. nothing to show here...")
-            return 0
-
-        #dirty hack, to fix hn link to items from the same site.
-        title=title.replace("from?site=", "https://news.ycombinator.com/from?site=")
-
-        print(f"""
+        return f"""
 <!-- item start //-->
  <tr class='athing' id='{entry_id}'>
     <td align="right" valign="top" class="title"><span class="rank">{item_num}.</span></td>
@@ -577,43 +2538,20 @@ class FormatPage:
     </td>
  </tr>
  <!-- item end //-->
-""", file=self.page_file)
-        return 1
-
-
-    def show_page_footer(self, page_number):
-        if self.verbose:
-            print(f"show page footer next-page: {page_number}")
 
-        print(f"""
-          <tr class="spacer" style="height:5px"></tr>
-          <tr class="morespace" style="height:10px"></tr>
-          <tr>
-            <td colspan="2"></td>
-            <td class="title">
-              <a
-                href="{self.prefix}{page_number+1}.html"
-                class="morelink"
-                >More</a
-              >
-            </td>
-          </tr>
-      </table>
-   </td>
-</tr>
-</table>
-""", file=self.page_file)
-
-        self.page_file.close()
-        self.page_file = None
-
-    def show_page_header(self, page_number):
-        if self.verbose:
-            print(f"show page footer {page_number}")
-
-        self.page_file = open(f"{self.prefix}{page_number}.html", "w")
+"""
 
-        print( f"""
+    # changes when the page template changes
+    @staticmethod
+    def template_hash(title_idx):
+        template = repr((PageRenderer.VERSION, PageRenderer.page_header(title_idx), PageRenderer.FOOTER_START, PageRenderer.FOOTER_END))
+        return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def page_header(title_idx):
+        header = PageRenderer.headers.get(title_idx)
+        if header is None:
+            header = f"""
 <html lang="en" op="newest">
    <head>
       <meta name="referrer" content="origin">
@@ -626,7 +2564,7 @@ class FormatPage:
       <center>
         <img src="data/hn3.png" style="width: 75vw"/>
         <br/>
-        <a href="{FormatPage.link[ self.title_idx ]}" align="left">{FormatPage.title[ self.title_idx ]}</a>
+        <a href="{PageRenderer.link[ title_idx ]}" align="left">{PageRenderer.title[ title_idx ]}</a>
         <br/>
         <table id="hnmain" border="0" cellpadding="0" cellspacing="0" width="85%" bgcolor="#f6f6ef">
             <tr>
@@ -650,9 +2588,307 @@ class FormatPage:
                <td>
                   <table border="0" cellpadding="0" cellspacing="0" class="itemlist">
 
-""", file=self.page_file)
 
+"""
+            PageRenderer.headers[title_idx] = header
+        return header
+
+
+# runs in a worker process of FormatPage, returns (page text, seconds it took): the metrics are in the main process
+def render_page_worker(verbose, prefix, title_idx, page_number, page_items):
+    start = time.perf_counter()
+    text = PageRenderer(verbose, prefix, title_idx).render_page(page_number, page_items)
+    return text, time.perf_counter() - start
+
+
+class FormatPage:
+
+    ITEMS_PER_PAGE = 30
+
+    # remembers hash of the rows behind each page, for incremental formatting
+    MANIFEST_FILE = "format_manifest.json"
+
+    def __init__(self, verbose, dbparams, incremental=False, jobs=1, stable_pages=False):
+        self.verbose = verbose
+        self.dblayer = make_dblayer(verbose, dbparams)
+        self.prefix = None
+        self.title_idx = 0
+        self.incremental = incremental
+        self.stable_pages = stable_pages
+        self.jobs = jobs
+        self.pool = None
+        self.pending = collections.deque()
+        self.manifest = {}
+        self.pages_written = 0
+        self.pages_unchanged = 0
+
+
+    def format(self):
+        print("'Nobody has any intention of building a wall' Walter Ulbricht")
 
+        self.load_manifest()
+
+        if self.jobs > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+
+        self.title_idx = 0
+        self.prefix = "page_"
+        self.format_one(True)
+
+        self.title_idx = 1
+        self.prefix = "comments_"
+        self.format_one(False)
+
+        self.wait_pages(0)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        self.save_manifest()
+        print("pages written:", self.pages_written, "pages unchanged:", self.pages_unchanged)
+
+    def load_manifest(self):
+        self.manifest = {}
+        if os.path.exists(FormatPage.MANIFEST_FILE):
+            with open(FormatPage.MANIFEST_FILE, "r") as file:
+                self.manifest = json.load(file)
+
+    def save_manifest(self):
+        with open(FormatPage.MANIFEST_FILE, "w") as file:
+            json.dump(self.manifest, file, indent=1)
+
+
+    # ITEMS_PER_PAGE rows a page, the newest first. With stable_pages the pages are filled from the oldest post
+    # instead: the first page gets what is left over. A newly flagged post then changes the first page only (with
+    # --incremental the other pages stay), until the first page is full; then there is one page more, and all
+    # pages change.
+    def format_one(self, show_articles):
+
+        print("format:", show_articles)
+
+        page_items = []
+        page_count = 0
+        page_size = FormatPage.ITEMS_PER_PAGE
+        if self.stable_pages:
+            page_size = self.count_items(show_articles) % FormatPage.ITEMS_PER_PAGE or FormatPage.ITEMS_PER_PAGE
+
+        for row in self.dblayer.find_non_active(show_articles):
+            title = FormatPage.item_title(row, show_articles)
+            if title is None:
+                if self.verbose:
+                    print(f"item {row[0]} flagged into oblivion. nothing to show here...")
+                continue
+
+            page_items.append((row, title))
+            if len(page_items) == page_size:
+                page_count += 1
+                self.write_page(page_count, page_items)
+                page_items = []
+                page_size = FormatPage.ITEMS_PER_PAGE
+
+        if page_items:
+            page_count += 1
+            self.write_page(page_count, page_items)
+
+        self.remove_pages(page_count)
+
+    # number of rows that are shown (one more pass over the rows of find_non_active)
+    def count_items(self, show_articles):
+        return sum(1 for row in self.dblayer.find_non_active(show_articles) if FormatPage.item_title(row, show_articles) is not None)
+
+    # there are fewer pages than before: remove the pages after the last one, and their manifest entries
+    def remove_pages(self, page_count):
+        page_name = re.compile(re.escape(self.prefix) + r"(\d+)\.html")
+        for file_name in set(os.listdir(".")) | set(self.manifest):
+            match = page_name.fullmatch(file_name)
+            if match is None or int(match.group(1)) <= page_count:
+                continue
+            self.manifest.pop(file_name, None)
+            if os.path.exists(file_name):
+                if self.verbose:
+                    print("remove page:", file_name)
+                os.remove(file_name)
+
+    # write a page, for incremental formatting: only if the rows of the page changed since the last run.
+    def write_page(self, page_number, page_items):
+        file_name = f"{self.prefix}{page_number}.html"
+
+        rows = [row for row, _ in page_items]
+        page_hash = hashlib.sha256(repr((PageRenderer.template_hash(self.title_idx), rows)).encode("utf-8")).hexdigest()
+
+        metrics.report_if_due()
+        if self.incremental and os.path.exists(file_name) and self.manifest.get(file_name, {}).get("hash") == page_hash:
+            self.pages_unchanged += 1
+            metrics.count("pages_unchanged")
+            return
+
+        self.manifest[file_name] = {
+            "hash": page_hash,
+            "first_entry_id": rows[0][0],
+            "last_entry_id": rows[-1][0],
+            "rows": len(rows)
+        }
+
+        if self.pool is None:
+            with metrics.timer("render"):
+                text = PageRenderer(self.verbose, self.prefix, self.title_idx).render_page(page_number, page_items)
+            FormatPage.write_file(file_name, text)
+        else:
+            # page numbers are given out here, in order; the workers just render.
+            # don't queue too many pages, the rows of queued pages are in memory.
+            future = self.pool.submit(render_page_worker, self.verbose, self.prefix, self.title_idx, page_number, page_items)
+            self.pending.append((file_name, future))
+            self.wait_pages(4 * self.jobs)
+        self.pages_written += 1
+        metrics.count("pages_written")
+
+    # write rendered pages from the worker processes, until there are no more than max_pending pages left
+    def wait_pages(self, max_pending):
+        while len(self.pending) > max_pending:
+            file_name, future = self.pending.popleft()
+            text, render_seconds = future.result()
+            metrics.observe("render", render_seconds)
+            FormatPage.write_file(file_name, text)
+
+    # the page is written with one write call
+    @staticmethod
+    def write_file(file_name, text):
+        with metrics.timer("write_page"), open(file_name, "wb") as file:
+            file.write(text.encode("utf-8"))
+
+    # title of an item as shown on the page, None if the item is not shown
+    @staticmethod
+    def item_title(row, show_articles):
+        title = row[2]
+
+        # the crawler stores cleaned up titles, rows crawled before that still need it.
+        if HNCrawlerUtil.needs_clean_title(title, show_articles):
+            title = HNCrawlerUtil.clean_title(title, show_articles)
+
+        if title == "[flagged]":
+            return None
+        return title
+
+
+# writes the posts to a directory of columnar files, one per month of created_at (<dir>/month=2021-11/posts.parquet),
+# for analysis with vectorized tools (pyarrow, pandas, duckdb, ...) away from the crawl db.
+# Incremental: the months with posts that were written since the last export (posts.change_id) are written again.
+class PostExporter:
+    STATE_NAME = "export"
+
+    # rows per record batch
+    BATCH_ROWS = 10000
+
+    def __init__(self, verbose, dbparams, export_dir, export_format, full=False):
+        self.verbose = verbose
+        self.dblayer = make_dblayer(verbose, dbparams)
+        self.export_dir = export_dir
+        self.export_format = export_format
+        self.full = full
+
+    @staticmethod
+    def schema():
+        return pyarrow.schema([
+            ("entryid", pyarrow.int64()),
+            ("tab", pyarrow.int32()),
+            ("title", pyarrow.string()),
+            ("nscore", pyarrow.int32()),
+            ("ncomments", pyarrow.int32()),
+            ("author", pyarrow.string()),
+            ("created_at", pyarrow.timestamp("us", tz="UTC")),
+            ("status", pyarrow.int32()),
+            ("ispost", pyarrow.bool_()),
+            ("last_checked_at", pyarrow.timestamp("us", tz="UTC")),
+        ])
+
+    def export(self):
+        if pyarrow is None:
+            print("Error: export needs pyarrow (pip3 install pyarrow)")
+            sys.exit(1)
+
+        # an export of an older version (saved exported_at) is followed by a full export
+        state = self.dblayer.load_crawl_state(PostExporter.STATE_NAME)
+        since = None
+        if state is not None and "change_id" in state and not self.full:
+            since = state["change_id"]
+            print("export posts changed since change id:", since)
+
+        # posts written after this point are picked up by the next export (some of the ones before it too)
+        change_id = self.dblayer.export_change_id()
+        months = self.dblayer.find_export_months(since)
+
+        num_rows = 0
+        for month_start in months:
+            num_rows += self.export_month(month_start)
+
+        self.dblayer.save_crawl_state(PostExporter.STATE_NAME, { "change_id": change_id })
+        self.dblayer.commit()
+        print("months exported:", len(months), "rows:", num_rows)
+
+    def export_month(self, month_start):
+        if month_start.month == 12:
+            month_end = month_start.replace(year=month_start.year + 1, month=1)
+        else:
+            month_end = month_start.replace(month=month_start.month + 1)
+
+        file_name = os.path.join(self.export_dir, f"month={month_start:%Y-%m}", "posts." + self.export_format)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        tmp_file_name = file_name + ".tmp"
+
+        schema = PostExporter.schema()
+        if self.export_format == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(tmp_file_name, schema, compression="zstd")
+        else:
+            writer = pyarrow.ipc.new_file(tmp_file_name, schema)
+
+        num_rows = 0
+        with writer:
+            columns = [[] for _ in schema]
+            rows = PostExporter.keep_titles(self.dblayer.find_posts_created(month_start, month_end), self.exported_titles(file_name))
+            for row in rows:
+                for column, value in zip(columns, row):
+                    column.append(value)
+                if len(columns[0]) == PostExporter.BATCH_ROWS:
+                    num_rows += PostExporter.write_batch(writer, schema, columns)
+                    columns = [[] for _ in schema]
+            if columns[0]:
+                num_rows += PostExporter.write_batch(writer, schema, columns)
+
+        # readers see the old or the new file, never a partial one
+        os.replace(tmp_file_name, file_name)
+        if self.verbose:
+            print("exported", file_name, "rows:", num_rows)
+        return num_rows
+
+    # (entryid, title) of the rows of an exported month file, in the order of entryid (the order they are written in)
+    def exported_titles(self, file_name):
+        if not os.path.exists(file_name):
+            return
+        if self.export_format == "parquet":
+            batches = pyarrow.parquet.ParquetFile(file_name).iter_batches(columns=["entryid", "title"])
+        else:
+            reader = pyarrow.ipc.open_file(file_name)
+            batches = (reader.get_batch(index) for index in range(reader.num_record_batches))
+        for batch in batches:
+            yield from zip(batch.column("entryid").to_pylist(), batch.column("title").to_pylist())
+
+    # a title that was exported once stays in the export: db --prune-comments drops the title of old comments in the
+    # db, not in the archive. rows and old_titles are both ordered by entryid, they are merged as they come.
+    @staticmethod
+    def keep_titles(rows, old_titles):
+        old_entry_id, old_title = next(old_titles, (None, None))
+        for row in rows:
+            if row[2] is None:
+                while old_entry_id is not None and old_entry_id < row[0]:
+                    old_entry_id, old_title = next(old_titles, (None, None))
+                if old_entry_id == row[0] and old_title is not None:
+                    row = row[:2] + (old_title,) + row[3:]
+            yield row
+
+    @staticmethod
+    def write_batch(writer, schema, columns):
+        writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+        return len(columns[0])
 
 
 def parse_cmd_line():
@@ -703,6 +2939,22 @@ Scanner for 'hacker news - red flag eddition' project
         help="set postgress host (for db connect)",
     )
 
+    parent_parser.add_argument(
+        "--storage",
+        default="postgres",
+        choices=["postgres", "sqlite"],
+        dest="storage",
+        help="where posts are stored: postgres - the postgres db (--db, --user, --host), sqlite - an sqlite file (--sqlite-path)"
+    )
+
+    parent_parser.add_argument(
+        "--sqlite-path",
+        default="rf-hn.sqlite",
+        type=str,
+        dest="sqlite_path",
+        help="with --storage sqlite: the sqlite file"
+    )
+
     parent_parser.add_argument(
         "--prompt",
         "-p",
@@ -712,6 +2964,94 @@ Scanner for 'hacker news - red flag eddition' project
         help="prompts for the db password"
     )
 
+    parent_parser.add_argument(
+        "--fetch",
+        default="http",
+        choices=["http", "curl"],
+        dest="fetch",
+        help="how to fetch pages: http - in process client with keep-alive connections, curl - run curl for each page"
+    )
+
+    parent_parser.add_argument(
+        "--timeout",
+        default=30.0,
+        type=float,
+        dest="timeout",
+        help="with --fetch http: timeout in seconds for connecting/reading"
+    )
+
+    parent_parser.add_argument(
+        "--retries",
+        default=3,
+        type=int,
+        dest="retries",
+        help="with --fetch http: number of retries for a failed request (with exponential backoff)"
+    )
+
+    parent_parser.add_argument(
+        "--source",
+        default="html",
+        choices=["html", "api"],
+        dest="source",
+        help="where to get items from: html - the item pages, api - the json api (much less data per item)"
+    )
+
+    parent_parser.add_argument(
+        "--hn-url",
+        default=HNCrawlerUtil.HN_URL,
+        type=str,
+        dest="hn_url",
+        help="base url of the site for item and listing pages (can point to a local server, see bench.py serve)"
+    )
+
+    parent_parser.add_argument(
+        "--api-url",
+        default="https://hacker-news.firebaseio.com/v0",
+        type=str,
+        dest="api_url",
+        help="with --source api: base url of the api (can point to a local server with json fixtures)"
+    )
+
+    parent_parser.add_argument(
+        "--cache",
+        default="",
+        type=str,
+        dest="cache_dir",
+        help="with --fetch http: directory of the page cache (raw pages, compressed; empty - no cache)"
+    )
+
+    parent_parser.add_argument(
+        "--cache-ttl",
+        default=0,
+        type=int,
+        dest="cache_ttl",
+        help="with --cache: seconds a cached page is used without asking the server (0 - always revalidate)"
+    )
+
+    parent_parser.add_argument(
+        "--cache-size",
+        default=2048,
+        type=int,
+        dest="cache_size",
+        help="with --cache: maximum size of the page cache in MB (least recently used pages are dropped)"
+    )
+
+    parent_parser.add_argument(
+        "--metrics-interval",
+        default=60,
+        type=int,
+        dest="metrics_interval",
+        help="print a summary line of the metrics (items/sec, time per stage, counts) every that many seconds (0 - never)"
+    )
+
+    parent_parser.add_argument(
+        "--metrics-file",
+        default="",
+        type=str,
+        dest="metrics_file",
+        help="write the metrics to this file in the prometheus text format, with each summary (for the node_exporter textfile collector)"
+    )
+
     subparsers = parent_parser.add_subparsers(dest='command')
 
     parser = subparsers.add_parser('crawl', help='crawl hn (new crawler, crawls a range of entry ids')
@@ -734,6 +3074,42 @@ Scanner for 'hacker news - red flag eddition' project
         help="set lowest entry id to start crawl"
     )
 
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        default=1,
+        type=int,
+        dest="concurrency",
+        help="number of item fetches in flight (1 - fetch one item after the other)"
+    )
+
+    parser.add_argument(
+        "--rate",
+        "-r",
+        default=4.0,
+        type=float,
+        dest="rate",
+        help="with --concurrency: maximum number of requests per second to the same host (0 - no limit)"
+    )
+
+    parser.add_argument(
+        "--resume",
+        "-s",
+        default=False,
+        action="store_true",
+        dest="resume",
+        help="continue the last crawl where it stopped, unless --from/--to are given (and skip entry id ranges that were crawled completely)"
+    )
+
+    parser.add_argument(
+        "--classify",
+        "-k",
+        default=False,
+        action="store_true",
+        dest="classify",
+        help="fetch the api item first, the item page only for posts and flagged/deleted items (active comments that are not in the db are skipped once they are older than 10 days)"
+    )
+
     parser.add_argument(
         "--init",
         "-i",
@@ -744,6 +3120,140 @@ Scanner for 'hacker news - red flag eddition' project
     )
 
 
+    parser = subparsers.add_parser('shard', help='split an entry id range into shards, for the worker subcommand')
+
+    parser.add_argument(
+        "--from",
+        "-f",
+        default=-1,
+        type=int,
+        dest="from_entry",
+        help="highest entry id of the range (default: find the highest)"
+    )
+
+    parser.add_argument(
+        "--to",
+        "-t",
+        default=0,
+        type=int,
+        dest="to_entry",
+        help="lowest entry id of the range"
+    )
+
+    parser.add_argument(
+        "--size",
+        "-z",
+        default=100000,
+        type=int,
+        dest="shard_size",
+        help="number of entry ids in a shard"
+    )
+
+    parser.add_argument(
+        "--status",
+        "-s",
+        default=False,
+        action="store_true",
+        dest="status",
+        help="show the number of open/claimed/done shards (doesn't create shards)"
+    )
+
+    parser = subparsers.add_parser('worker', help='crawl shards created by the shard subcommand, until all are done')
+
+    parser.add_argument(
+        "--lease",
+        "-l",
+        default=300,
+        type=int,
+        dest="lease",
+        help="seconds before a shard is given to another worker, if this worker doesn't make progress"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        default=1,
+        type=int,
+        dest="concurrency",
+        help="number of item fetches in flight (1 - fetch one item after the other)"
+    )
+
+    parser.add_argument(
+        "--rate",
+        "-r",
+        default=4.0,
+        type=float,
+        dest="rate",
+        help="with --concurrency: maximum number of requests per second to the same host (0 - no limit)"
+    )
+
+    parser = subparsers.add_parser('tail', help='follow new posts: keep polling for new entry ids and fetch them (runs until stopped)')
+
+    parser.add_argument(
+        "--interval",
+        "-n",
+        default=30.0,
+        type=float,
+        dest="interval",
+        help="seconds between two polls for new entry ids"
+    )
+
+    parser.add_argument(
+        "--limit",
+        "-l",
+        default=200,
+        type=int,
+        dest="limit",
+        help="maximum number of posts that are rechecked after each poll (0 - all that are due)"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        default=1,
+        type=int,
+        dest="concurrency",
+        help="number of item fetches in flight (1 - fetch one item after the other)"
+    )
+
+    parser.add_argument(
+        "--rate",
+        "-r",
+        default=4.0,
+        type=float,
+        dest="rate",
+        help="with --concurrency: maximum number of requests per second to the same host (0 - no limit)"
+    )
+
+    parser = subparsers.add_parser('recheck', help='fetch the posts that are due for a recheck')
+
+    parser.add_argument(
+        "--limit",
+        "-l",
+        default=0,
+        type=int,
+        dest="limit",
+        help="maximum number of posts to recheck (0 - all that are due)"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        default=1,
+        type=int,
+        dest="concurrency",
+        help="number of item fetches in flight (1 - fetch one item after the other)"
+    )
+
+    parser.add_argument(
+        "--rate",
+        "-r",
+        default=4.0,
+        type=float,
+        dest="rate",
+        help="with --concurrency: maximum number of requests per second to the same host (0 - no limit)"
+    )
+
     parser = subparsers.add_parser('oldcrawl', help='crawl hn (old crawler, crawl the front page, then crawl the next page, etc)')
 
     parser.add_argument(
@@ -774,6 +3284,15 @@ Scanner for 'hacker news - red flag eddition' project
         help="tab to crawl (0 - newest, 1 - new, 2 - ask, 3 - show)"
     )
 
+    parser.add_argument(
+        "--resume",
+        "-s",
+        default=False,
+        action="store_true",
+        dest="resume",
+        help="continue the last crawl of the tab at the page where it stopped"
+    )
+
     parser = subparsers.add_parser('format', help='format the site')
 
     # formatting of site
@@ -786,6 +3305,62 @@ Scanner for 'hacker news - red flag eddition' project
         help="format the page from db content",
     )
 
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        default=False,
+        action="store_true",
+        dest="incremental",
+        help="only rewrite pages whose rows changed since the last run (see format_manifest.json)",
+    )
+
+    parser.add_argument(
+        "--stable-pages",
+        default=False,
+        action="store_true",
+        dest="stable_pages",
+        help="with --incremental: fill the pages from the oldest post, the first page gets the rest. A newly flagged post then changes the first page only, not all of them",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        default=1,
+        type=int,
+        dest="jobs",
+        help="number of processes that render pages (1 - render in this process)",
+    )
+
+    parser = subparsers.add_parser('export', help='write the posts to columnar files (parquet/arrow), one per month, for analysis')
+
+    parser.add_argument(
+        "--dir",
+        "-d",
+        default="export",
+        type=str,
+        dest="export_dir",
+        help="directory of the exported files",
+    )
+
+    parser.add_argument(
+        "--format",
+        "-f",
+        default="parquet",
+        choices=["parquet", "arrow"],
+        dest="export_format",
+        help="parquet - compressed, arrow - arrow ipc file (can be memory mapped)",
+    )
+
+    parser.add_argument(
+        "--full",
+        default=False,
+        action="store_true",
+        dest="full",
+        help="write all months, not just the ones with posts that changed since the last export",
+    )
+
+    parser = subparsers.add_parser('reparse', help='rebuild the posts from the item pages in the page cache (--cache), without fetching')
+
     parser = subparsers.add_parser('db', help='db commands')
 
     parser.add_argument(
@@ -806,6 +3381,48 @@ Scanner for 'hacker news - red flag eddition' project
         help="show entry_id of the earliest entry",
     )
 
+    parser.add_argument(
+        "--upgrade",
+        "-u",
+        default=False,
+        action="store_true",
+        dest="upgrade",
+        help="add the tables/columns/indexes of newer versions to an existing db",
+    )
+
+    parser.add_argument(
+        "--flag-stats",
+        "-f",
+        default=False,
+        action="store_true",
+        dest="flag_stats",
+        help="show how long it takes until posts/comments are flagged (from the post history)",
+    )
+
+    parser.add_argument(
+        "--partition",
+        default=False,
+        action="store_true",
+        dest="partition",
+        help="migrate the posts table to a table that is partitioned by entry id range (postgres only, stop the crawlers first)",
+    )
+
+    parser.add_argument(
+        "--partition-size",
+        default=DBLayer.PARTITION_SIZE,
+        type=int,
+        dest="partition_size",
+        help="with --partition: number of entry ids per partition",
+    )
+
+    parser.add_argument(
+        "--prune-comments",
+        default=0,
+        type=int,
+        dest="prune_days",
+        help="drop the title of active comments that are older than this number of days (they are not shown on the site, at least the 10 days after which a comment is no longer rechecked, 0 - don't)",
+    )
+
 
     return parent_parser.parse_args()
 
@@ -815,31 +3432,103 @@ def make_site():
 
     args = parse_cmd_line()
 
+    metrics.configure(args.metrics_interval, args.metrics_file)
+
     db_pass = ''
     if args.prompt_password:
         db_pass = getpass.getpass(prompt="DB Password: ")
 
-    dbparams = { 'dbname' : args.db, 'user': args.user, 'host': args.host, 'pass': db_pass }
+    dbparams = { 'dbname' : args.db, 'user': args.user, 'host': args.host, 'pass': db_pass, 'storage': args.storage, 'sqlite_path': args.sqlite_path }
+
+    fetchparams = {
+        'backend': args.fetch,
+        'timeout': args.timeout,
+        'retries': args.retries,
+        'source': args.source,
+        'hn_url': args.hn_url,
+        'api_url': args.api_url,
+        'cache_dir': args.cache_dir,
+        'cache_ttl': args.cache_ttl,
+        'cache_size': args.cache_size
+    }
 
     if args.command == "format":
 
-        page = FormatPage(args.verbose, dbparams)
+        if args.stable_pages and not args.incremental:
+            print("Error: --stable-pages needs --incremental")
+            sys.exit(1)
+
+        page = FormatPage(args.verbose, dbparams, args.incremental, args.jobs, args.stable_pages)
 
         page.format()
+        page.dblayer.close()
 
     elif args.command == "crawl":
 
-        crawler = HHCrawlerOnEntryIdRange(args.verbose, args.from_entry, args.to_entry, dbparams)
+        crawler = HHCrawlerOnEntryIdRange(args.verbose, args.from_entry, args.to_entry, dbparams, fetchparams, args.resume, args.classify)
 
         if args.init:
             crawler.dblayer.make_tbl()
 
-        crawler.scan()
+        crawler.scan(args.concurrency, args.rate)
+        crawler.dblayer.close()
+
+
+    elif args.command == "shard":
+
+        crawler = HHCrawlerOnEntryIdRange(args.verbose, args.from_entry, args.to_entry, dbparams, fetchparams)
+
+        if args.status:
+            for state, num_shards, entries_left in crawler.dblayer.shard_status():
+                print("state:", ("open", "claimed", "done")[state], "shards:", num_shards, "entry ids left:", entries_left)
+        else:
+            if crawler.entry_id_from == -1:
+                crawler.entry_id_from = crawler.find_highest_entry_id()
+            HNShardWorker.make_shards(crawler.dblayer, crawler.entry_id_from, crawler.entry_id_to, args.shard_size)
+        crawler.dblayer.close()
+
+    elif args.command == "worker":
+
+        worker = HNShardWorker(args.verbose, dbparams, fetchparams, args.lease, args.concurrency, args.rate)
+
+        worker.run()
+        worker.dblayer.close()
+
+    elif args.command == "tail":
+
+        crawler = HNTailCrawler(args.verbose, dbparams, fetchparams, args.interval, args.limit, args.concurrency, args.rate)
+
+        crawler.run()
+
+    elif args.command == "recheck":
+
+        crawler = HHCrawlerOnEntryIdRange(args.verbose, -1, 0, dbparams, fetchparams)
+
+        crawler.recheck(args.limit, args.concurrency, args.rate)
+        crawler.dblayer.close()
+
+    elif args.command == "export":
+
+        exporter = PostExporter(args.verbose, dbparams, args.export_dir, args.export_format, args.full)
+
+        exporter.export()
+        exporter.dblayer.close()
 
+    elif args.command == "reparse":
+
+        cache = make_page_cache(args.verbose, fetchparams)
+        if cache is None:
+            print("Error: reparse needs the page cache directory (--cache)")
+            sys.exit(1)
+
+        crawler = HHCrawlerOnEntryIdRange(args.verbose, -1, 0, dbparams, fetchparams)
+
+        crawler.reparse(cache)
+        crawler.dblayer.close()
 
     elif args.command == "oldcrawl":
 
-        crawler = HNCrawlerFollowNextPage(args.verbose, dbparams)
+        crawler = HNCrawlerFollowNextPage(args.verbose, dbparams, fetchparams, args.resume)
 
         if args.tab < HNCrawlerUtil.TAB_NEWEST or args.tab > HNCrawlerUtil.TAB_SHOW:
             print("Error: tab value invalid")
@@ -850,10 +3539,29 @@ def make_site():
             crawler.dblayer.make_tbl()
 
         crawler.scan(args.maxpage, args.tab)
+        crawler.dblayer.close()
 
     elif args.command == "db":
 
-        dblayer = DBLayer(args.verbose, dbparams)
+        dblayer = make_dblayer(args.verbose, dbparams)
+
+        if args.upgrade:
+            dblayer.upgrade_tbl()
+            dblayer.add_partitions(dblayer.max_entry_id())
+
+        if args.partition:
+            if args.storage != "postgres":
+                print("Error: --partition needs --storage postgres")
+                sys.exit(1)
+            dblayer.partition_tbl(args.partition_size)
+
+        if args.prune_days > 0:
+            if args.prune_days * 24 * 3600 < RecheckScheduler.MAX_AGE:
+                print(f"Error: --prune-comments must be at least {RecheckScheduler.MAX_AGE // (24 * 3600)} days, younger comments are still rechecked")
+                sys.exit(1)
+            cutoff = dblayer.db_now() - timedelta(days=args.prune_days)
+            num_pruned = dblayer.prune_comments(cutoff, DBLayer.PARTITION_SIZE // 10)
+            print("pruned comments:", num_pruned)
 
         if args.max_entry:
             print( dblayer.find_post_latest(True) )
@@ -861,11 +3569,25 @@ def make_site():
         if args.min_entry:
             print( dblayer.find_post_latest(False) )
 
+        if args.flag_stats:
+            for ispost, num_posts, median, p90, average in dblayer.flag_stats():
+                kind = "posts" if ispost else "comments"
+                print(f"time to flag {kind}: {num_posts} flagged, median: {median / 3600:.1f} hours, 90th percentile: {p90 / 3600:.1f} hours, average: {float(average) / 3600:.1f} hours")
+
+        dblayer.close()
+
     else:
         print("Error: no action specified")
         sys.exit(1)
 
+    if args.metrics_interval > 0 or args.metrics_file:
+        metrics.report()
+
 
 
 if __name__ == '__main__':
-    make_site()
+    try:
+        make_site()
+    except ThrottledError as err:
+        print("Error:", err)
+        sys.exit(1)